@@ -0,0 +1,157 @@
+"""
+asyncio engine
+Runs the server on an asyncio event loop without importing twisted at all.
+The loop is wrapped so the server sees the same clock and transport interface
+it gets from the twisted reactor
+"""
+
+import asyncio
+import socket
+from typing import Tuple
+
+from ingress import Ingress
+from metrics import Metrics
+from server import Server
+
+METRICS_READ_TIMEOUT_SECONDS = 5
+
+loop = asyncio.new_event_loop()
+
+
+class AsyncioDelayedCall:
+
+    def __init__(self, delay: float, f, args):
+        self.called = False
+        self.handle = loop.call_later(delay, self.fire, f, args)
+
+    def fire(self, f, args):
+        self.called = True
+        f(*args)
+
+    def active(self) -> bool:
+        return not self.called and not self.handle.cancelled()
+
+    def cancel(self):
+        self.handle.cancel()
+
+
+class AsyncioClock:
+
+    @staticmethod
+    def callLater(delay: float, f, *args) -> AsyncioDelayedCall:
+        return AsyncioDelayedCall(delay, f, args)
+
+    @staticmethod
+    def seconds() -> float:
+        return loop.time()
+
+
+class AsyncioTransport:
+
+    def __init__(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def write(self, payload: bytes, address: Tuple):
+        self.transport.sendto(payload, address)
+
+
+class ProbeProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, received):
+        self.received = received
+
+    def datagram_received(self, data: bytes, address: Tuple):
+        self.received(data, address)
+
+
+class BatchedReader:
+    # Reads the socket when ingress reads in batches, closing it only stops reading
+
+    def __init__(self, ingress: Ingress):
+        self.fd = ingress.socket.fileno()
+        loop.add_reader(self.fd, ingress.read)
+
+    def close(self):
+        loop.remove_reader(self.fd)
+
+
+class UdpListener:
+
+    def __init__(self, udp_socket: socket.socket, transport):
+        self.socket = udp_socket
+        self.transport = transport
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def stop(self):
+        self.transport.close()
+
+
+class AsyncioProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server: Server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = AsyncioTransport(transport)
+
+    def datagram_received(self, data: bytes, address: Tuple):
+        self.server.datagramReceived(data, address)
+
+
+def create_server() -> Server:
+    return Server(AsyncioClock())
+
+
+def listen(port: int, server: Server, udp_socket: socket.socket = None) -> UdpListener:
+    """
+    Starts reading from the given socket, or from a new one bound to the port
+    """
+    if udp_socket is None:
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(("", port))
+    udp_socket.setblocking(False)
+    ingress = Ingress(udp_socket, server)
+    if ingress.batched:
+        server.transport = ingress
+        return UdpListener(udp_socket, BatchedReader(ingress))
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(lambda: AsyncioProtocol(server),
+                                                                         sock=udp_socket))
+    return UdpListener(udp_socket, transport)
+
+
+def listen_probe(port: int, received):
+    """
+    Listens on a probe port, received is called with every datagram and its source address
+    """
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: ProbeProtocol(received),
+                                                          local_addr=("0.0.0.0", port)))
+
+
+def serve_metrics(port: int, metrics: Metrics):
+    # Minimal HTTP server, every request gets the metrics whatever the path is
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), METRICS_READ_TIMEOUT_SECONDS)
+            body = metrics.render().encode("utf-8")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    loop.run_until_complete(asyncio.start_server(handle, "127.0.0.1", port))
+
+
+def run():
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def stop():
+    loop.stop()
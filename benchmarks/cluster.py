@@ -0,0 +1,93 @@
+"""
+Loopback check of the cluster mode
+Starts several nodes on consecutive loopback ports, creates a session on the first one and
+checks that the others learn about it: hosting the same name elsewhere is refused, and
+connecting or pinging through another node gets redirected to the owner. Then it stops the
+owner and checks its sessions are forgotten. Reports how long the gossip took each time
+Run it from the repository root with: python3 -m benchmarks.cluster [--nodes N] [--port N]
+"""
+import argparse
+import socket
+import subprocess
+import time
+
+from benchmarks.engines import start_server, wait_first_response
+
+GOSSIP_PORT_OFFSET = 100
+POLL_SECONDS = 0.01
+TIMEOUT_SECONDS = 15
+
+
+def start_node(port: int, gossip_port: int, peer_gossip_ports: list) -> subprocess.Popen:
+    peers = ",".join(f"127.0.0.1:{peer}" for peer in peer_gossip_ports)
+    return start_server("twisted", port, ["--cluster-port", str(gossip_port), "--cluster-peers", peers])
+
+
+def request(client: socket.socket, address, datagram: bytes) -> bytes:
+    client.sendto(datagram, address)
+    try:
+        return client.recv(2048)
+    except socket.timeout:
+        return b""
+
+
+def wait_for(client: socket.socket, address, datagram: bytes, expected: bytes) -> float:
+    # Repeats the request until the reply starts with the expected bytes, returns how long it took
+    started = time.perf_counter()
+    while time.perf_counter() - started < TIMEOUT_SECONDS:
+        if request(client, address, datagram).startswith(expected):
+            return time.perf_counter() - started
+        time.sleep(POLL_SECONDS)
+    raise RuntimeError(f"No {expected!r} reply to {datagram!r} from {address}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster mode loopback check")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--port", type=int, default=47400)
+    args = parser.parse_args()
+
+    ports = [args.port + index for index in range(args.nodes)]
+    gossip_ports = [port + GOSSIP_PORT_OFFSET for port in ports]
+    addresses = [("127.0.0.1", port) for port in ports]
+    nodes = [start_node(port, gossip_port, [peer for peer in gossip_ports if peer != gossip_port])
+             for port, gossip_port in zip(ports, gossip_ports)]
+    host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    guest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for address in addresses:
+            # A socket of its own so the replies to these requests do not get in the way later
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                wait_first_response(probe, address)
+        host.settimeout(0.5)
+        guest.settimeout(0.5)
+        if not request(host, addresses[0], b"h:Shared:Host:4").startswith(b"i:"):
+            raise RuntimeError("Could not create the session on the first node")
+        owner = f"r:127.0.0.1:{ports[0]}".encode()
+        for index in range(1, args.nodes):
+            elapsed = wait_for(guest, addresses[index], b"c:Shared:Guest", owner)
+            print(f"node {index} redirects connections after {elapsed * 1e3:.0f} ms")
+            wait_for(guest, addresses[index], b"p:Shared:Guest", owner)
+            if request(guest, addresses[index], b"h:Shared:Other:4") != b"error:session_exists":
+                raise RuntimeError(f"Node {index} let the session be hosted again")
+        if not request(guest, addresses[0], b"c:Shared:Guest").startswith(b"i:"):
+            raise RuntimeError("Could not join the session on its owner")
+        print("hosting the same name on other nodes is refused, joining through the owner works")
+
+        nodes[0].terminate()
+        nodes[0].wait()
+        started = time.perf_counter()
+        for index in range(1, args.nodes):
+            wait_for(guest, addresses[index], b"c:Shared:Guest", b"error:session_non_existent")
+        print(f"sessions of the stopped node forgotten after {(time.perf_counter() - started) * 1e3:.0f} ms")
+    finally:
+        host.close()
+        guest.close()
+        for node in nodes:
+            if node.poll() is None:
+                node.terminate()
+                node.wait()
+
+
+if __name__ == '__main__':
+    main()
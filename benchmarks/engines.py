@@ -0,0 +1,80 @@
+"""
+Compares the twisted and asyncio engines
+For each engine it starts main.py, measures the time until the first request is answered
+and then the ping throughput with a window of requests in flight from a single client
+Run it from the repository root with: python3 -m benchmarks.engines [--seconds N] [--window N]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ENGINES = ("twisted", "asyncio")
+STARTUP_TIMEOUT_SECONDS = 10
+STARTUP_POLL_SECONDS = 0.005
+
+
+def start_server(engine: str, port: int, extra_args: list = ()) -> subprocess.Popen:
+    # Starts main.py without rate limiting, the other benchmarks start theirs with this too
+    main_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    return subprocess.Popen([sys.executable, main_file, str(port), "--engine", engine, "--no-rate-limit"]
+                            + list(extra_args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_first_response(client: socket.socket, address) -> float:
+    # Keeps sending the host request until the server is up and answers it
+    started = time.perf_counter()
+    client.settimeout(STARTUP_POLL_SECONDS)
+    while time.perf_counter() - started < STARTUP_TIMEOUT_SECONDS:
+        client.sendto(b"h:Bench:Host:2", address)
+        try:
+            if client.recv(2048).startswith(b"i:"):
+                return time.perf_counter() - started
+        except (socket.timeout, ConnectionRefusedError):
+            pass
+    raise RuntimeError("Server did not start")
+
+
+def ping_throughput(client: socket.socket, address, seconds: float, window: int) -> float:
+    client.settimeout(0.5)
+    sent = received = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        while sent - received < window:
+            client.sendto(b"p:Bench:Host", address)
+            sent += 1
+        try:
+            client.recv(2048)
+            received += 1
+        except socket.timeout:
+            # Something got lost, open the window again
+            received = sent
+    return received / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Twisted vs asyncio engine benchmark")
+    parser.add_argument("--port", type=int, default=47200)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--window", type=int, default=32)
+    args = parser.parse_args()
+
+    address = ("127.0.0.1", args.port)
+    print(f"{'engine':<10}{'startup (ms)':>14}{'pings/s':>12}")
+    for engine in ENGINES:
+        server_process = start_server(engine, args.port)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            startup = wait_first_response(client, address)
+            throughput = ping_throughput(client, address, args.seconds, args.window)
+        finally:
+            client.close()
+            server_process.terminate()
+            server_process.wait()
+        print(f"{engine:<10}{startup * 1e3:>14.1f}{throughput:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Loopback check of the hot restart
+For each engine it starts main.py with --hot-restart, opens a session with two players,
+starts a second main.py on the same port while the host keeps pinging, and checks that
+the old process exits, the session survives and how long pings went unanswered
+Run it from the repository root with: python3 -m benchmarks.hotrestart [--port N]
+"""
+import argparse
+import socket
+import time
+
+from benchmarks.engines import ENGINES, start_server, wait_first_response
+
+PING_INTERVAL_SECONDS = 0.001
+RESTART_TIMEOUT_SECONDS = 10
+SETTLE_SECONDS = 0.5
+
+
+def ping_until(client: socket.socket, address, done) -> float:
+    # Pings at a steady rate until done() is true, returns the longest time without a reply
+    client.settimeout(PING_INTERVAL_SECONDS)
+    last_reply = time.perf_counter()
+    longest_gap = 0.0
+    started = last_reply
+    while not done():
+        if time.perf_counter() - started > RESTART_TIMEOUT_SECONDS:
+            raise RuntimeError("Hot restart did not finish")
+        client.sendto(b"p:Bench:Host", address)
+        try:
+            if client.recv(2048).startswith(b"i:"):
+                now = time.perf_counter()
+                longest_gap = max(longest_gap, now - last_reply)
+                last_reply = now
+        except socket.timeout:
+            pass
+    return longest_gap
+
+
+def run(engine: str, port: int) -> float:
+    address = ("127.0.0.1", port)
+    host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    guest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    old_process = start_server(engine, port, ["--hot-restart"])
+    new_process = None
+    try:
+        wait_first_response(host, address)
+        guest.settimeout(1)
+        guest.sendto(b"c:Bench:Guest", address)
+        if not guest.recv(2048).startswith(b"i:"):
+            raise RuntimeError("Guest could not join")
+        # Gives the old process time to open its control socket
+        time.sleep(SETTLE_SECONDS)
+        new_process = start_server(engine, port, ["--hot-restart"])
+        exited_at = []
+
+        def restarted() -> bool:
+            # Keeps pinging for a while after the old process exits to catch the new one's first reply
+            if not exited_at and old_process.poll() is not None:
+                exited_at.append(time.perf_counter())
+            return bool(exited_at) and time.perf_counter() - exited_at[0] > SETTLE_SECONDS
+
+        downtime = ping_until(host, address, restarted)
+        host.settimeout(1)
+        host.sendto(b"p:Bench:Host", address)
+        reply = host.recv(2048)
+        if reply != b"i:Host:Guest":
+            raise RuntimeError(f"Session lost on restart, got {reply!r}")
+        return downtime
+    finally:
+        host.close()
+        guest.close()
+        for process in (old_process, new_process):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot restart loopback check")
+    parser.add_argument("--port", type=int, default=47300)
+    args = parser.parse_args()
+
+    print(f"{'engine':<10}{'longest gap (ms)':>18}")
+    for engine in ENGINES:
+        print(f"{engine:<10}{run(engine, args.port) * 1e3:>18.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Burst ingress check
+Starts main.py on each engine, with the engine reading the socket and with batched reads,
+sends a burst of pings as fast as possible and then reads the server metrics, checking that
+every datagram was either handled or counted as dropped by the kernel. Reports how many the
+server read, how many the kernel dropped and how long the server took to drain the burst
+Run it from the repository root with: python3 -m benchmarks.ingress [--burst N] [--receive-buffer BYTES]
+"""
+import argparse
+import re
+import socket
+import time
+import urllib.request
+
+from benchmarks.engines import ENGINES, start_server, wait_first_response
+
+METRICS_PORT_OFFSET = 1
+DRAIN_TIMEOUT_SECONDS = 10
+
+
+def metrics_args(port: int) -> list:
+    # Arguments of main.py serving the metrics scrape reads
+    return ["--metrics-port", str(port + METRICS_PORT_OFFSET)]
+
+
+def scrape(port: int) -> dict:
+    # Every unlabelled and labelled sample, e.g. "kernel_drops_total{source=\"proc\"}" -> value
+    with urllib.request.urlopen(f"http://127.0.0.1:{port + METRICS_PORT_OFFSET}/metrics") as response:
+        body = response.read().decode("utf-8")
+    return {match[0]: float(match[1]) for match in re.findall(r"^rabid_hole_punch_(\S+) (\S+)$", body, re.M)}
+
+
+def wait_metrics(port: int) -> dict:
+    deadline = time.perf_counter() + DRAIN_TIMEOUT_SECONDS
+    while True:
+        try:
+            return scrape(port)
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def burst(port: int, count: int) -> tuple:
+    """
+    Sends the pings and waits until the server has either read or lost all of them.
+    Returns the datagrams read, the kernel drops and the seconds until the last one was read
+    """
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ("127.0.0.1", port)
+    try:
+        wait_first_response(client, address)
+        before = wait_metrics(port)
+        started = time.perf_counter()
+        for _ in range(count):
+            client.sendto(b"p:Bench:Host", address)
+        deadline = started + DRAIN_TIMEOUT_SECONDS
+        while True:
+            after = scrape(port)
+            received = after["packets_received_total"] - before["packets_received_total"]
+            drops = (after.get('kernel_drops_total{source="proc"}', 0)
+                     - before.get('kernel_drops_total{source="proc"}', 0))
+            if received + drops >= count or time.perf_counter() > deadline:
+                return int(received), int(drops), time.perf_counter() - started
+            time.sleep(0.01)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Burst ingress check")
+    parser.add_argument("--port", type=int, default=47500)
+    parser.add_argument("--burst", type=int, default=50000)
+    parser.add_argument("--receive-buffer", type=int, default=None, help="SO_RCVBUF of the server socket")
+    parser.add_argument("--read-batch", type=int, default=64)
+    args = parser.parse_args()
+
+    buffer_args = ["--receive-buffer", str(args.receive_buffer)] if args.receive_buffer else []
+    modes = (("engine", []), (f"batch {args.read_batch}", ["--read-batch", str(args.read_batch)]))
+    print(f"{'engine':<10}{'reads':<12}{'read':>10}{'dropped':>10}{'lost':>8}{'drain (ms)':>12}")
+    for engine in ENGINES:
+        for mode, mode_args in modes:
+            server_process = start_server(engine, args.port, metrics_args(args.port) + buffer_args + mode_args)
+            try:
+                received, drops, elapsed = burst(args.port, args.burst)
+            finally:
+                server_process.terminate()
+                server_process.wait()
+            # Neither read nor counted by the kernel, should always be 0
+            lost = args.burst - received - drops
+            print(f"{engine:<10}{mode:<12}{received:>10}{drops:>10}{lost:>8}{elapsed * 1e3:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
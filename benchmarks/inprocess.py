@@ -0,0 +1,148 @@
+"""
+In-process benchmark of the server
+Calls Server.datagramReceived directly with a fake transport, so it measures the cost of
+parsing, handling and cleanup without any socket in between
+Run it from the repository root with: python3 -m benchmarks.inprocess [--sessions N] [--json FILE]
+Results written with --json include the current commit so they can be compared across commits.
+Logging is set to WARNING, so the info line written for every join is not part of the measure
+"""
+import argparse
+import json
+import logging
+import subprocess
+import time
+
+from twisted.internet.task import Clock
+
+import logger
+import model
+import server as server_module
+from server import Server
+
+PLAYERS_PER_SESSION = 4
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+
+    def write(self, payload: bytes, address):
+        self.packets += 1
+        self.bytes += len(payload)
+
+
+def player_address(session_index: int, player_index: int):
+    # Every player gets its own IP so the rate limiter does not get in the way
+    number = session_index * PLAYERS_PER_SESSION + player_index
+    return f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}", 40000 + player_index
+
+
+def new_server() -> Server:
+    server = Server(Clock())
+    server.transport = FakeTransport()
+    return server
+
+
+def fill(server: Server, sessions: int) -> float:
+    started = time.perf_counter()
+    for i in range(sessions):
+        server.datagramReceived(f"h:S{i}:P0:{PLAYERS_PER_SESSION}".encode(), player_address(i, 0))
+        for j in range(1, PLAYERS_PER_SESSION):
+            server.datagramReceived(f"c:S{i}:P{j}".encode(), player_address(i, j))
+    return time.perf_counter() - started
+
+
+def ping_all(server: Server, sessions: int) -> float:
+    datagrams = [(f"p:S{i}:P{j}".encode(), player_address(i, j))
+                 for i in range(sessions) for j in range(PLAYERS_PER_SESSION)]
+    started = time.perf_counter()
+    for datagram, address in datagrams:
+        server.datagramReceived(datagram, address)
+    return time.perf_counter() - started
+
+
+def ping_all_by_token(server: Server, sessions: int) -> float:
+    datagrams = [(f"p:{player.token}".encode(), player.address)
+                 for i in range(sessions) for player in server.active_sessions[f"S{i}"].players.values()]
+    started = time.perf_counter()
+    for datagram, address in datagrams:
+        server.datagramReceived(datagram, address)
+    return time.perf_counter() - started
+
+
+def versioned_ping_all(server: Server, sessions: int) -> float:
+    # Clients that are up to date, so every reply is an ack
+    datagrams = []
+    for i in range(sessions):
+        session = server.active_sessions[f"S{i}"]
+        datagrams += [(f"v:{player.token}:{session.version}".encode(), player.address)
+                      for player in session.players.values()]
+    started = time.perf_counter()
+    for datagram, address in datagrams:
+        server.datagramReceived(datagram, address)
+    return time.perf_counter() - started
+
+
+def reply_bytes(server: Server, ping, sessions: int) -> float:
+    # Bytes sent per request by one more round of the given pings
+    sent = server.transport.bytes
+    ping(server, sessions)
+    return (server.transport.bytes - sent) / (sessions * PLAYERS_PER_SESSION)
+
+
+def cleanup(server: Server, sessions: int, expired_fraction: float) -> float:
+    # The clock jumps past the player timeout and every player except the ones
+    # of the first sessions is marked as seen right at that moment. This is the worst case
+    # for the expiry index, every player is due for re-validation in the same pass
+    now = model.current_time_millis() + model.PLAYER_TIMEOUT_MSECS + 1
+    for i in range(int(sessions * expired_fraction), sessions):
+        for player in server.active_sessions[f"S{i}"].players.values():
+            player.last_seen = now
+    real_clock = model.current_time_millis
+    server_module.current_time_millis = model.current_time_millis = lambda: now
+    try:
+        started = time.perf_counter()
+        server.cleanup_players()
+        return time.perf_counter() - started
+    finally:
+        server_module.current_time_millis = model.current_time_millis = real_clock
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process server benchmark")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--expired", type=float, default=0.01, help="fraction of sessions timed out on cleanup")
+    parser.add_argument("--json", default=None, help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    logger.LOG_LEVEL = logging.WARNING
+    server = new_server()
+    datagrams = args.sessions * PLAYERS_PER_SESSION
+    results = {"commit": current_commit(), "sessions": args.sessions}
+    results["join_us_per_request"] = fill(server, args.sessions) / datagrams * 1e6
+    results["ping_us_per_request"] = ping_all(server, args.sessions) / datagrams * 1e6
+    results["token_ping_us_per_request"] = ping_all_by_token(server, args.sessions) / datagrams * 1e6
+    results["versioned_ping_us_per_request"] = versioned_ping_all(server, args.sessions) / datagrams * 1e6
+    results["ping_reply_bytes"] = reply_bytes(server, ping_all, args.sessions)
+    results["versioned_ping_reply_bytes"] = reply_bytes(server, versioned_ping_all, args.sessions)
+    results["cleanup_ms"] = cleanup(server, args.sessions, args.expired) * 1e3
+    results["packets_sent"] = server.transport.packets
+
+    for key, value in results.items():
+        print(f"{key:<32}{value:>14.2f}" if isinstance(value, float) else f"{key:<32}{value:>14}")
+    if args.json:
+        with open(args.json, "a") as output:
+            output.write(json.dumps(results) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+Load generator driving the full session lifecycle over loopback
+Every simulated lobby follows the README flow: the host creates the session, the rest of
+players connect and everybody pings for a while. Then some lobbies lose a player by exit,
+kick or timeout, and finally the host starts the session and everybody confirms
+Each client binds its own 127.x.y.z address, so rate limiting applies per client as in production, even with --rate-limit-by-ip
+Run it from the repository root with: python3 -m benchmarks.loadgen [--lobbies N] [--players N]
+By default it starts main.py on the given port, waits until it answers, and reports the CPU time
+and RSS of all its processes (the supervisor and its workers with --workers)
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from errors import ERR_PLAYER_TIMEOUT, ERR_SESSION_PLAYER_EXIT, ERR_SESSION_PLAYER_KICKED_BY_HOST
+
+RESPONSE_TIMEOUT_SECONDS = 2
+PLAYER_TIMEOUT_WAIT_SECONDS = 15
+SERVER_READY_TIMEOUT_SECONDS = 30
+# SO_REUSEPORT spreads sources over the workers, so probing from many ports reaches all of them
+PROBE_CLIENTS = 32
+PROBE_RESEND_SECONDS = 0.2
+
+
+class Stats:
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.latencies: Dict[str, List[float]] = {}
+        self.lobbies_started = 0
+
+    def add_latency(self, message_type: str, seconds: float):
+        self.latencies.setdefault(message_type, []).append(seconds)
+
+
+class Client(asyncio.DatagramProtocol):
+
+    def __init__(self, name: str, server_address, stats: Stats):
+        self.name = name
+        self.server_address = server_address
+        self.stats = stats
+        self.transport = None
+        self.inbox: asyncio.Queue = asyncio.Queue()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address):
+        self.stats.received += 1
+        self.inbox.put_nowait(data)
+
+    def send(self, message: str):
+        self.stats.sent += 1
+        self.transport.sendto(message.encode("utf-8"), self.server_address)
+
+    async def wait_for(self, prefix: bytes, timeout: float = RESPONSE_TIMEOUT_SECONDS):
+        # Discards everything else received meanwhile (e.g. broadcasts of the session info)
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            data = await asyncio.wait_for(self.inbox.get(), remaining)
+            if data.startswith(prefix):
+                return data
+
+    async def request(self, message: str, expected: bytes):
+        started = time.perf_counter()
+        self.send(message)
+        try:
+            response = await self.wait_for(expected)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            return None
+        self.stats.add_latency(message[0], time.perf_counter() - started)
+        return response
+
+
+async def open_client(loop, index: int, name: str, server_address, stats: Stats) -> Client:
+    # 127.0.0.0/8 is all loopback on Linux, each client uses a different address from it
+    number = index + 1
+    local_ip = f"127.{(number >> 16) + 1}.{(number >> 8) & 255}.{number & 255}"
+    _, client = await loop.create_datagram_endpoint(lambda: Client(name, server_address, stats),
+                                                    local_addr=(local_ip, 0))
+    return client
+
+
+async def run_lobby(loop, lobby: int, args, server_address, stats: Stats):
+    session = f"L{lobby}"
+    all_clients = [await open_client(loop, lobby * args.players + i, f"P{i}", server_address, stats)
+                   for i in range(args.players)]
+    clients = list(all_clients)
+    host = clients[0]
+    try:
+        await host.request(f"h:{session}:{host.name}:{args.players}", b"i:")
+        for client in clients[1:]:
+            await client.request(f"c:{session}:{client.name}", b"i:")
+
+        for _ in range(args.pings):
+            await asyncio.gather(*[client.request(f"p:{session}:{client.name}", b"i:") for client in clients])
+            await asyncio.sleep(args.ping_interval)
+
+        if len(clients) > 2:
+            leaver = clients[-1]
+            dice = random.random()
+            if dice < args.exit_rate:
+                await leaver.request(f"x:{session}:{leaver.name}", ERR_SESSION_PLAYER_EXIT.encode())
+                clients.remove(leaver)
+            elif dice < args.exit_rate + args.kick_rate:
+                host.send(f"k:{session}:{leaver.name}")
+                await leaver.wait_for(ERR_SESSION_PLAYER_KICKED_BY_HOST.encode())
+                clients.remove(leaver)
+            elif dice < args.exit_rate + args.kick_rate + args.timeout_rate:
+                # Everybody else keeps pinging while the leaver waits to be kicked out
+                clients.remove(leaver)
+                waiting = asyncio.ensure_future(leaver.wait_for(ERR_PLAYER_TIMEOUT.encode(),
+                                                                PLAYER_TIMEOUT_WAIT_SECONDS))
+                while not waiting.done():
+                    await asyncio.gather(*[client.request(f"p:{session}:{client.name}", b"i:")
+                                           for client in clients])
+                    await asyncio.sleep(args.ping_interval)
+                waiting.result()
+
+        started = time.perf_counter()
+        host.send(f"s:{session}:{host.name}")
+        for client in clients:
+            await client.wait_for(b"s:")
+            stats.add_latency("s", time.perf_counter() - started)
+            client.send(f"y:{session}:{client.name}")
+        stats.lobbies_started += 1
+    except asyncio.TimeoutError:
+        stats.timeouts += 1
+    finally:
+        for client in all_clients:
+            client.transport.close()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def process_stat(pid: int) -> List[str]:
+    # Fields of /proc/<pid>/stat after the command name, which can contain spaces
+    with open(f"/proc/{pid}/stat") as stat:
+        return stat.read().rsplit(")", 1)[1].split()
+
+
+def process_tree(pid: int) -> List[int]:
+    """
+    Returns the process and its children, e.g. the supervisor and its workers (Linux only)
+    """
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                if int(process_stat(int(entry))[1]) == pid:
+                    children.append(int(entry))
+            except (OSError, IndexError):
+                pass
+    return [pid] + children
+
+
+def process_usage(pid: int):
+    """
+    Returns (cpu seconds, rss bytes) of the process and its children added up, reading /proc (Linux only)
+    """
+    cpu = rss = 0
+    for process in process_tree(pid):
+        try:
+            fields = process_stat(process)
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    return cpu, rss
+
+
+def expected_processes(server_args: List[str]) -> int:
+    # With --workers the server runs a supervisor plus one process per worker
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--workers", type=int, default=1)
+    workers = parser.parse_known_args(server_args)[0].workers
+    return 1 if workers <= 1 else 1 + workers
+
+
+def wait_ready(server_address, pid: int, processes: int):
+    """
+    Waits until the server runs all its processes and answers a list request from each of PROBE_CLIENTS ports
+    """
+    deadline = time.perf_counter() + SERVER_READY_TIMEOUT_SECONDS
+    while pid and len(process_tree(pid)) < processes:
+        if time.perf_counter() > deadline:
+            raise RuntimeError("The server did not start all its processes")
+        time.sleep(0.1)
+    probes = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(PROBE_CLIENTS)]
+    try:
+        for probe in probes:
+            probe.settimeout(PROBE_RESEND_SECONDS)
+            while True:
+                if time.perf_counter() > deadline:
+                    raise RuntimeError("The server did not answer")
+                probe.sendto(b"l:f:0", server_address)
+                try:
+                    if probe.recv(2048).startswith(b"l:"):
+                        break
+                except OSError:
+                    pass
+    finally:
+        for probe in probes:
+            probe.close()
+
+
+async def run(args, server_address) -> Stats:
+    loop = asyncio.get_running_loop()
+    stats = Stats()
+    # Lobbies are started in waves so the host is not hit by every creation at once
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(lobby):
+        async with semaphore:
+            await run_lobby(loop, lobby, args, server_address, stats)
+
+    await asyncio.gather(*[limited(lobby) for lobby in range(args.lobbies)])
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load generator for the hole punch server")
+    parser.add_argument("--port", type=int, default=47100)
+    parser.add_argument("--no-spawn", action="store_true", help="use a server already running on --port")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid to measure when using --no-spawn")
+    parser.add_argument("--lobbies", type=int, default=250)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=250, help="lobbies running at the same time")
+    parser.add_argument("--pings", type=int, default=5)
+    parser.add_argument("--ping-interval", type=float, default=1)
+    parser.add_argument("--exit-rate", type=float, default=0.1)
+    parser.add_argument("--kick-rate", type=float, default=0.1)
+    parser.add_argument("--timeout-rate", type=float, default=0.05)
+    parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[],
+                        help="extra arguments for main.py, must be the last option")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server_process = None
+    pid = args.server_pid
+    processes = 1
+    if not args.no_spawn:
+        main_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+        server_process = subprocess.Popen([sys.executable, main_file, str(args.port)] + args.server_args,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = server_process.pid
+        processes = expected_processes(args.server_args)
+
+    try:
+        wait_ready(("127.0.0.1", args.port), pid, processes)
+        usage_before = process_usage(pid) if pid else None
+        measured = len(process_tree(pid)) if pid else 0
+        started = time.perf_counter()
+        stats = asyncio.run(run(args, ("127.0.0.1", args.port)))
+        elapsed = time.perf_counter() - started
+        usage_after = process_usage(pid) if pid else None
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    print(f"Lobbies started: {stats.lobbies_started}/{args.lobbies} in {elapsed:.2f}s")
+    print(f"Packets sent: {stats.sent} ({stats.sent / elapsed:.0f}/s), "
+          f"received: {stats.received} ({stats.received / elapsed:.0f}/s), timeouts: {stats.timeouts}")
+    for message_type, latencies in sorted(stats.latencies.items()):
+        print(f"  {message_type}: {len(latencies):>7} responses  p50 {percentile(latencies, 0.5) * 1e3:7.2f} ms"
+              f"  p99 {percentile(latencies, 0.99) * 1e3:7.2f} ms")
+    if usage_before and usage_after:
+        print(f"Server CPU ({measured} processes): "
+              f"{usage_after[0] - usage_before[0]:.2f}s ({(usage_after[0] - usage_before[0]) / elapsed * 100:.1f}%), "
+              f"RSS: {usage_after[1] / 2 ** 20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Memory used per idle session
+Fills a server with sessions that only have their host (or a few players) and nobody pings,
+then reports how much the process grew per session, counting every index the server keeps.
+Rate limiting is disabled, its memory is capped by RATE_LIMIT_MAX_BUCKETS anyway
+Run it from the repository root with: python3 -m benchmarks.memory [--sessions N] [--players N]
+"""
+import argparse
+import logging
+import os
+import time
+
+from twisted.internet.task import Clock
+
+import logger
+import server as server_module
+from server import Server
+
+
+class NullTransport:
+
+    def write(self, payload: bytes, address):
+        pass
+
+
+def resident_bytes() -> int:
+    # Current resident set size, not the peak, so it can be measured before and after
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def player_address(number: int):
+    return f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}", 40000 + (number >> 24)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory used per idle session")
+    parser.add_argument("--sessions", type=int, default=1000000)
+    parser.add_argument("--players", type=int, default=1, help="players in each session, host included")
+    args = parser.parse_args()
+
+    logger.LOG_LEVEL = logging.WARNING
+    server_module.RATE_LIMIT_ENABLED = False
+    server = Server(Clock())
+    server.transport = NullTransport()
+
+    before = resident_bytes()
+    started = time.perf_counter()
+    for i in range(args.sessions):
+        number = i * args.players
+        server.datagramReceived(f"h:S{i}:P0:{max(2, args.players)}".encode(), player_address(number))
+        for j in range(1, args.players):
+            server.datagramReceived(f"c:S{i}:P{j}".encode(), player_address(number + j))
+    elapsed = time.perf_counter() - started
+    grown = resident_bytes() - before
+
+    print(f"sessions              {args.sessions:>14}")
+    print(f"players per session   {args.players:>14}")
+    print(f"fill seconds          {elapsed:>14.1f}")
+    print(f"resident MiB          {grown / (1 << 20):>14.1f}")
+    print(f"bytes per session     {grown / args.sessions:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
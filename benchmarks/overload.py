@@ -0,0 +1,176 @@
+"""
+Load shedding under a ping flood
+Starts main.py with and without load shedding, floods it from other processes with pings
+from players of many lobbies plus garbage requests, more than it can handle, and meanwhile
+takes other lobbies through join, start and confirmation like a real client would (resending
+every request until it is answered). Reports how long joins and starts took, how many lobbies
+could not start in time, and what the server shed, from its metrics
+Run it from the repository root with: python3 -m benchmarks.overload [--rate N] [--lobbies N]
+"""
+import argparse
+import multiprocessing
+import socket
+import time
+from typing import List, Optional
+
+from benchmarks.engines import start_server
+from benchmarks.ingress import metrics_args, scrape, wait_metrics
+from benchmarks.loadgen import percentile
+
+RESEND_SECONDS = 0.2
+# Clients give up on a start after this, which fails the hole punch of the whole lobby
+START_TIMEOUT_SECONDS = 2
+FLOOD_LOBBIES = 200
+FLOOD_BURST_SECONDS = 0.01
+# One in this many flood datagrams is garbage that gets an invalid request error
+GARBAGE_EVERY = 10
+WARMUP_SECONDS = 2
+
+
+def flood(port: int, index: int, rate: float, seconds: float):
+    """
+    Hosts FLOOD_LOBBIES lobbies, then sends pings of their hosts at the given rate
+    """
+    address = ("127.0.0.1", port)
+    clients = []
+    for lobby in range(FLOOD_LOBBIES):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if request(client, f"h:F{index}x{lobby}:Host:2".encode(), address, b"i:", START_TIMEOUT_SECONDS) is None:
+            raise RuntimeError("The server did not create a flood lobby")
+        client.setblocking(False)
+        clients.append((client, f"p:F{index}x{lobby}:Host".encode()))
+    per_burst = max(1, int(rate * FLOOD_BURST_SECONDS))
+    sent = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for _ in range(per_burst):
+            client, ping = clients[sent % len(clients)]
+            try:
+                client.sendto(ping if sent % GARBAGE_EVERY else b"zz", address)
+            except BlockingIOError:
+                pass
+            sent += 1
+        delay = started + sent / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    for client, _ in clients:
+        client.close()
+
+
+def request(client: socket.socket, message: bytes, address, prefix: bytes, timeout: float) -> Optional[float]:
+    # Resends the request until a reply starting with prefix arrives, returns the seconds it took or None
+    started = time.perf_counter()
+    client.sendto(message, address)
+    resend_at = started + RESEND_SECONDS
+    while time.perf_counter() - started < timeout:
+        client.settimeout(max(0.001, min(resend_at, started + timeout) - time.perf_counter()))
+        try:
+            if client.recv(2048).startswith(prefix):
+                return time.perf_counter() - started
+        except socket.timeout:
+            if time.perf_counter() >= resend_at:
+                client.sendto(message, address)
+                resend_at += RESEND_SECONDS
+    return None
+
+
+def wait_start(client: socket.socket, started: float) -> Optional[float]:
+    # The server keeps sending the start message until it is confirmed, nothing to resend
+    while time.perf_counter() - started < START_TIMEOUT_SECONDS:
+        client.settimeout(max(0.001, started + START_TIMEOUT_SECONDS - time.perf_counter()))
+        try:
+            if client.recv(2048).startswith(b"s:"):
+                return time.perf_counter() - started
+        except socket.timeout:
+            pass
+    return None
+
+
+def milliseconds(values: List[float], fraction: float) -> float:
+    return percentile(values, fraction) * 1e3 if values else float("nan")
+
+
+def run_lobbies(port: int, lobbies: int, mode: str) -> tuple:
+    """
+    Returns the join and start latencies and the number of lobbies that did not start in time
+    """
+    address = ("127.0.0.1", port)
+    joins: List[float] = []
+    starts: List[float] = []
+    failed = 0
+    for lobby in range(lobbies):
+        session = f"M{mode[:1]}{lobby}"
+        host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        guest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            created = request(host, f"h:{session}:Host:2".encode(), address, b"i:", START_TIMEOUT_SECONDS)
+            joined = request(guest, f"c:{session}:Guest".encode(), address, b"i:", START_TIMEOUT_SECONDS) \
+                if created is not None else None
+            if joined is None:
+                failed += 1
+                continue
+            joins.append(joined)
+            started = time.perf_counter()
+            # The host resends the start request until its start message arrives, the rest just wait for theirs
+            host_start = request(host, f"s:{session}:Host".encode(), address, b"s:", START_TIMEOUT_SECONDS)
+            guest_start = wait_start(guest, started)
+            if host_start is None or guest_start is None:
+                failed += 1
+                continue
+            starts.append(max(host_start, guest_start))
+            host.sendto(f"y:{session}:Host".encode(), address)
+            guest.sendto(f"y:{session}:Guest".encode(), address)
+        finally:
+            host.close()
+            guest.close()
+    return joins, starts, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load shedding under a ping flood")
+    parser.add_argument("--port", type=int, default=47800)
+    parser.add_argument("--engine", choices=("twisted", "asyncio"), default="twisted")
+    parser.add_argument("--rate", type=float, default=100000, help="flood datagrams per second")
+    parser.add_argument("--flooders", type=int, default=2, help="processes sending the flood")
+    parser.add_argument("--lobbies", type=int, default=50, help="lobbies started during the flood")
+    parser.add_argument("--max-lag", type=float, default=None, metavar="MS", help="--max-lag of the server")
+    args = parser.parse_args()
+
+    lag_args = ["--max-lag", str(args.max_lag)] if args.max_lag is not None else []
+    modes = (("shedding", lag_args), ("no shedding", lag_args + ["--no-load-shedding"]))
+    print(f"{'mode':<13}{'join p50':>9}{'p99 (ms)':>9}{'start p50':>10}{'p99 (ms)':>9}{'failed':>8}"
+          f"{'pings shed':>11}{'kept':>8}{'errors shed':>12}{'max lag (ms)':>13}{'kernel drops':>13}")
+    for mode, mode_args in modes:
+        server_process = start_server(args.engine, args.port, metrics_args(args.port) + mode_args)
+        flooders = []
+        try:
+            wait_metrics(args.port)
+            before = scrape(args.port)
+            seconds = WARMUP_SECONDS + args.lobbies * START_TIMEOUT_SECONDS
+            flooders = [multiprocessing.Process(target=flood, args=(args.port, index, args.rate / args.flooders,
+                                                                    seconds))
+                        for index in range(args.flooders)]
+            for flooder in flooders:
+                flooder.start()
+            time.sleep(WARMUP_SECONDS)
+            joins, starts, failed = run_lobbies(args.port, args.lobbies, mode)
+            after = scrape(args.port)
+        finally:
+            for flooder in flooders:
+                flooder.terminate()
+                flooder.join()
+            server_process.terminate()
+            server_process.wait()
+
+        decisions = [int(after.get(f'overload_decisions_total{{decision="{decision}"}}', 0))
+                     for decision in ("ping_shed", "ping_kept", "invalid_reply_shed")]
+        drops_key = 'kernel_drops_total{source="proc"}'
+        drops = int(after.get(drops_key, 0) - before.get(drops_key, 0))
+        print(f"{mode:<13}{milliseconds(joins, 0.5):>9.0f}{milliseconds(joins, 0.99):>9.0f}"
+              f"{milliseconds(starts, 0.5):>10.0f}{milliseconds(starts, 0.99):>9.0f}{failed:>8}"
+              f"{decisions[0]:>11}{decisions[1]:>8}{decisions[2]:>12}"
+              f"{after.get('event_loop_max_lag_seconds', 0) * 1e3:>13.0f}{drops:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of the text and binary request parsers
+Both parsers run in turns and the best of REPEATS runs is kept, so a noisy machine affects them alike
+Run it from the repository root with: python3 -m benchmarks.parsers [iterations]
+"""
+import sys
+import timeit
+
+from twisted.internet.task import Clock
+
+import protocol
+from model import Player, Session
+from server import Server
+
+ADDRESS = ("127.0.0.1", 5000)
+REPEATS = 10
+REQUESTS = {
+    "h": (b"h:NiceRoom:Alice:4:Pass", ("NiceRoom", "Alice", 4, "Pass")),
+    "c": (b"c:NiceRoom:Bob:Pass", ("NiceRoom", "Bob", "Pass")),
+    "p": (b"p:NiceRoom:Alice", ("NiceRoom", "Alice")),
+}
+
+
+def encode_binary_request(message_type: str, fields) -> bytes:
+    datagram = protocol.encode_header(message_type)
+    for field in fields:
+        datagram += bytes((field,)) if isinstance(field, int) else protocol.encode_name(field)
+    return datagram
+
+
+def parse_text(server: Server, datagram: bytes):
+    message_type, message = server.parse_datagram_string(datagram.decode("utf-8"), ADDRESS)
+    return message_type, server.message_parsers[message_type](message, ADDRESS)
+
+
+def main(iterations: int):
+    server = Server(Clock())
+    print(f"{'type':<6}{'text (ns/op)':>16}{'binary (ns/op)':>18}{'text bytes':>12}{'binary bytes':>14}")
+    for message_type, (text_datagram, fields) in REQUESTS.items():
+        binary_datagram = encode_binary_request(message_type, fields)
+        assert parse_text(server, text_datagram) == protocol.parse(binary_datagram)
+        text_time = binary_time = float("inf")
+        for _ in range(REPEATS):
+            text_time = min(text_time, timeit.timeit(lambda: parse_text(server, text_datagram), number=iterations))
+            binary_time = min(binary_time, timeit.timeit(lambda: protocol.parse(binary_datagram), number=iterations))
+        print(f"{message_type:<6}{text_time / iterations * 1e9:>16.0f}{binary_time / iterations * 1e9:>18.0f}"
+              f"{len(text_datagram):>12}{len(binary_datagram):>14}")
+
+    host = Player("Player0", "203.0.113.10", 50000)
+    session = Session("NiceRoom", 12, host)
+    for i in range(1, 12):
+        session.add_player(Player(f"Player{i}", f"203.0.113.{10 + i}", 50000 + i, binary=True))
+    text_start = session.get_start_payload(host)
+    binary_start = session.get_start_payload(session.players["Player1"])
+    print(f"Start message for 12 players: text {len(text_start)} bytes, binary {len(binary_start)} bytes")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
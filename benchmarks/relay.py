@@ -0,0 +1,113 @@
+"""
+Relay throughput over loopback
+Starts main.py --relay on each engine, with the engine reading the socket and with batched
+reads (which also sends relayed datagrams with one sendmsg and no copy), starts a session of
+two players and measures how many datagrams per second one player gets relayed to the other
+with a window of datagrams in flight
+Run it from the repository root with: python3 -m benchmarks.relay [--seconds N] [--payload BYTES]
+"""
+import argparse
+import os
+import socket
+import struct
+import time
+
+from benchmarks.engines import ENGINES, start_server, wait_first_response
+
+RELAY_HEADER = struct.Struct("!BI")
+RELAY_MAGIC = 0xFD
+# High enough for the session cap not to be what is measured
+BANDWIDTH = 1 << 40
+
+
+def relay_ids(start_message: bytes) -> dict:
+    # s:<own port>:<name>:<ip>:<port>:<relay id>;...
+    peers = start_message.decode("utf-8").split(":", 2)[2]
+    return {peer.split(":")[0]: int(peer.split(":")[3]) for peer in peers.split(";")}
+
+
+def start_session(host: socket.socket, guest: socket.socket, address, session: str = "Relay") -> tuple:
+    """
+    Creates and starts a session of two, returns the relay ids of the guest and the host
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        wait_first_response(probe, address)
+    host.settimeout(1)
+    guest.settimeout(1)
+    host.sendto(f"h:{session}:Host:2".encode(), address)
+    host.recv(2048)
+    guest.sendto(f"c:{session}:Guest".encode(), address)
+    guest.recv(2048)
+    host.sendto(f"s:{session}:Host".encode(), address)
+    # Each start message has the relay id of the other player
+    guest_id = relay_ids(wait_start(host))["Guest"]
+    host_id = relay_ids(wait_start(guest))["Host"]
+    # Confirm so the start messages stop being sent again
+    host.sendto(f"y:{session}:Host".encode(), address)
+    guest.sendto(f"y:{session}:Guest".encode(), address)
+    return guest_id, host_id
+
+
+def wait_start(client: socket.socket) -> bytes:
+    # Skips the session info messages sent while players joined
+    while True:
+        message = client.recv(2048)
+        if message.startswith(b"s:"):
+            return message
+
+
+def throughput(sender: socket.socket, receiver: socket.socket, address, datagram: bytes,
+               seconds: float, window: int) -> float:
+    receiver.settimeout(0.5)
+    sent = received = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        while sent - received < window:
+            sender.sendto(datagram, address)
+            sent += 1
+        try:
+            receiver.recv(65535)
+            received += 1
+        except socket.timeout:
+            # Something got lost, open the window again
+            received = sent
+    return received / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay throughput over loopback")
+    parser.add_argument("--port", type=int, default=47600)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--window", type=int, default=32)
+    parser.add_argument("--payload", type=int, default=200)
+    parser.add_argument("--read-batch", type=int, default=64)
+    args = parser.parse_args()
+
+    address = ("127.0.0.1", args.port)
+    modes = (("engine", []), (f"batch {args.read_batch}", ["--read-batch", str(args.read_batch)]))
+    print(f"{'engine':<10}{'reads':<12}{'datagrams/s':>12}{'Mbit/s':>10}")
+    for engine in ENGINES:
+        for mode, mode_args in modes:
+            server_process = start_server(engine, args.port,
+                                          ["--relay", "--relay-bandwidth", str(BANDWIDTH)] + mode_args)
+            host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            guest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                guest_id, host_id = start_session(host, guest, address)
+                payload = os.urandom(args.payload)
+                guest.sendto(RELAY_HEADER.pack(RELAY_MAGIC, host_id) + payload, address)
+                relayed = host.recv(65535)
+                if relayed != RELAY_HEADER.pack(RELAY_MAGIC, guest_id) + payload:
+                    raise RuntimeError("The relayed datagram is not the one sent with the sender relay id")
+                rate = throughput(guest, host, address, RELAY_HEADER.pack(RELAY_MAGIC, host_id) + payload,
+                                  args.seconds, args.window)
+            finally:
+                host.close()
+                guest.close()
+                server_process.terminate()
+                server_process.wait()
+            print(f"{engine:<10}{mode:<12}{rate:>12.0f}{rate * (args.payload + RELAY_HEADER.size) * 8 / 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Replays traffic recorded with main.py --capture
+Feeds the captured datagrams to a Server with a fake transport and a virtual clock, so
+timeouts, retransmissions and rate limiting happen at the captured times whatever the replay
+speed is, and the random tokens and session versions are the captured ones. By default it runs
+as fast as possible, --speed 1 keeps the captured pace (2 is twice as fast and so on).
+Reports the replay throughput, and with --against <git revision> replays the same capture on
+that revision too (checked out in a temporary worktree) and shows where the replies differ.
+--responses saves the replies in the capture format and --compare diffs them with saved ones
+Run it from the repository root with: python3 -m benchmarks.replay <capture> [--speed N] [--against REV]
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Dict, List, Tuple
+
+# Run as a script by --against, with the other revision first in the path
+import capture
+import logger
+import model
+import server as server_module
+
+from twisted.internet.task import Clock
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIFFS_SHOWN = 10
+
+
+class RecordingTransport:
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        # (virtual seconds, address, payload) of every datagram sent
+        self.sent: List[Tuple[float, Tuple, bytes]] = []
+
+    def write(self, payload: bytes, address):
+        self.sent.append((self.clock.seconds(), address, payload))
+
+
+class ReplayedRandom:
+    # Stands in for the random and secrets modules, handing out the captured values first
+
+    def __init__(self, values: deque, fallback):
+        self.values = values
+        self.fallback = fallback
+
+    def getrandbits(self, bits: int) -> int:
+        return self.values.popleft() if self.values else self.fallback.getrandbits(bits)
+
+    def randbits(self, bits: int) -> int:
+        return self.values.popleft() if self.values else self.fallback.randbits(bits)
+
+
+def advance_to(clock: Clock, seconds: float):
+    # Runs every call scheduled before that time at its own time, Clock.advance alone would run them all at the end
+    while clock.calls and clock.calls[0].getTime() <= seconds:
+        clock.advance(max(0, clock.calls[0].getTime() - clock.seconds()))
+    clock.advance(max(0, seconds - clock.seconds()))
+
+
+def new_server(clock: Clock):
+    try:
+        server = server_module.Server(clock)
+    except TypeError:
+        # Revisions before the server took its clock used the twisted reactor directly
+        server_module.reactor = clock
+        server = server_module.Server()
+    if hasattr(server, "rate_limiter"):
+        server.rate_limiter.clock = clock.seconds
+    server.transport = RecordingTransport(clock)
+    return server
+
+
+def replay(path: str, speed: float, drain_seconds: float) -> Tuple[List, int, float]:
+    """
+    Returns what the server sent, the number of datagrams replayed and the wall seconds it took
+    """
+    records = list(capture.read_capture(path))
+    datagrams = [(seconds, record) for kind, seconds, record in records if kind == capture.KIND_DATAGRAM]
+    tokens = deque(record for kind, _, record in records if kind == capture.KIND_TOKEN)
+    versions = deque(record for kind, _, record in records if kind == capture.KIND_SESSION_VERSION)
+
+    clock = Clock()
+    model.current_time_millis = server_module.current_time_millis = lambda: int(clock.seconds() * 1000)
+    # Older revisions may not draw one or the other
+    if hasattr(model, "random"):
+        model.random = ReplayedRandom(versions, model.random)
+    if hasattr(server_module, "secrets"):
+        server_module.secrets = ReplayedRandom(tokens, server_module.secrets)
+    server = new_server(clock)
+
+    started = time.perf_counter()
+    for seconds, (datagram, address) in datagrams:
+        if speed > 0:
+            delay = started + seconds / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        advance_to(clock, seconds)
+        server.datagramReceived(datagram, address)
+    elapsed = time.perf_counter() - started
+    # Let timeouts and retransmissions of the last requests happen
+    advance_to(clock, clock.seconds() + drain_seconds)
+    return server.transport.sent, len(datagrams), elapsed
+
+
+def save_responses(path: str, sent: List):
+    writer = capture.CaptureWriter(path)
+    for seconds, address, payload in sent:
+        writer.record(payload, address, int(seconds * 1e6))
+    writer.close()
+
+
+def load_responses(path: str) -> List:
+    return [(seconds, address, payload)
+            for kind, seconds, (payload, address) in capture.read_capture(path) if kind == capture.KIND_DATAGRAM]
+
+
+def by_address(sent: List) -> Dict[Tuple, List[bytes]]:
+    # Only the order of the replies to each client matters, not how they interleave with the rest
+    replies = {}
+    for _, address, payload in sent:
+        replies.setdefault(address, []).append(payload)
+    return replies
+
+
+def compare(sent: List, other: List, label: str):
+    replies, other_replies = by_address(sent), by_address(other)
+    different = [address for address in replies.keys() | other_replies.keys()
+                 if replies.get(address) != other_replies.get(address)]
+    print(f"replies                 {len(sent):>10} here, {len(other)} in {label}")
+    print(f"clients with different replies {len(different):>5} of {len(replies.keys() | other_replies.keys())}")
+    for address in sorted(different)[:DIFFS_SHOWN]:
+        here, there = replies.get(address, []), other_replies.get(address, [])
+        index = next((i for i, (a, b) in enumerate(zip(here, there)) if a != b), min(len(here), len(there)))
+        print(f"  {address[0]}:{address[1]} reply {index}: "
+              f"{here[index] if index < len(here) else None!r} here, "
+              f"{there[index] if index < len(there) else None!r} in {label}")
+
+
+def replay_revision(revision: str, args) -> List:
+    # Replays in a worktree of the revision, running this same script with that revision's modules first in the path
+    worktree = tempfile.mkdtemp(prefix="rabid-hole-punch-replay-")
+    subprocess.run(["git", "worktree", "add", "--detach", worktree, revision], cwd=REPOSITORY, check=True,
+                   stdout=subprocess.DEVNULL)
+    try:
+        responses = os.path.join(worktree, "responses.capture")
+        subprocess.run([sys.executable, os.path.abspath(__file__), os.path.abspath(args.capture),
+                        "--speed", str(args.speed), "--drain", str(args.drain), "--responses", responses],
+                       cwd=worktree, env=dict(os.environ, PYTHONPATH=os.pathsep.join([worktree, REPOSITORY])),
+                       check=True)
+        return load_responses(responses)
+    finally:
+        subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=REPOSITORY, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic")
+    parser.add_argument("capture", help="file written by main.py --capture")
+    parser.add_argument("--speed", type=float, default=0, help="times the captured pace, 0 for as fast as possible")
+    parser.add_argument("--drain", type=float, default=60,
+                        help="virtual seconds to keep running after the last datagram")
+    parser.add_argument("--responses", default=None, help="save the replies to this file")
+    parser.add_argument("--compare", default=None, help="diff the replies with ones saved with --responses")
+    parser.add_argument("--against", default=None, help="git revision to replay too and diff the replies with")
+    args = parser.parse_args()
+
+    logger.LOG_LEVEL = logging.WARNING
+    sent, replayed, elapsed = replay(args.capture, args.speed, args.drain)
+    print(f"datagrams replayed      {replayed:>10}")
+    print(f"replies sent            {len(sent):>10}")
+    print(f"wall seconds            {elapsed:>10.2f}")
+    print(f"datagrams per second    {replayed / elapsed if elapsed else 0:>10.0f}")
+    if args.responses is not None:
+        save_responses(args.responses, sent)
+    if args.compare is not None:
+        compare(sent, load_responses(args.compare), args.compare)
+    if args.against is not None:
+        print(f"--- {args.against}")
+        compare(sent, replay_revision(args.against, args), args.against)
+
+
+if __name__ == '__main__':
+    main()
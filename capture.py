@@ -0,0 +1,130 @@
+"""
+Traffic capture
+Appends every datagram the server receives, with its source address and the time it
+arrived, to a compact binary file so the traffic can be replayed later against any version
+of the server (see benchmarks/replay.py). Tokens and session versions the server draws at
+random are recorded too, so a replay hands out the same ones and the captured requests
+using them still match.
+Records go through a big write buffer that is flushed every second, recording one is a
+struct pack and a buffered write, and capturing stops by itself once the file reaches
+its size limit.
+
+File layout: the header, then records that all start with a kind byte and the microseconds
+since the capture started:
+  datagram  kind, micros, IP length, port, datagram length, packed IP, datagram
+  value     kind, micros, value (tokens and session versions)
+"""
+
+import socket
+import struct
+import time
+from typing import Iterator, Optional, Tuple
+
+import logger
+
+MAGIC = b"RHPC"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("!4sB")
+
+KIND_DATAGRAM = 0
+KIND_TOKEN = 1
+KIND_SESSION_VERSION = 2
+RECORD_PREFIX = struct.Struct("!BQ")
+DATAGRAM_RECORD = struct.Struct("!BQBHH")
+VALUE_RECORD = struct.Struct("!BQQ")
+
+WRITE_BUFFER_BYTES = 1 << 20
+FLUSH_SECONDS: float = 1
+# Capturing stops when the file gets this big, None for no limit
+MAX_BYTES: Optional[int] = 1 << 30
+
+
+def pack_ip(ip: str) -> bytes:
+    return socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)
+
+
+def unpack_ip(packed_ip: bytes) -> str:
+    return socket.inet_ntop(socket.AF_INET6 if len(packed_ip) == 16 else socket.AF_INET, packed_ip)
+
+
+class CaptureWriter:
+
+    def __init__(self, path: str, clock=None, max_bytes: Optional[int] = None):
+        # clock is only used to flush periodically, the server clock in capture mode
+        self.path = path
+        self.file = open(path, "wb", buffering=WRITE_BUFFER_BYTES)
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        self.written = HEADER.size
+        self.max_bytes = max_bytes
+        self.started_ns = time.monotonic_ns()
+        self.logger = logger.get_logger("Capture")
+        self.clock = clock
+        if clock is not None:
+            clock.callLater(FLUSH_SECONDS, self.flush)
+
+    def micros(self) -> int:
+        return (time.monotonic_ns() - self.started_ns) // 1000
+
+    def record(self, datagram: bytes, address: Tuple, micros: int = None):
+        """
+        Appends a datagram with its address, by default timestamped now
+        """
+        if self.file is None:
+            return
+        packed_ip = pack_ip(address[0])
+        record = DATAGRAM_RECORD.pack(KIND_DATAGRAM, self.micros() if micros is None else micros,
+                                      len(packed_ip), address[1], len(datagram)) + packed_ip + datagram
+        self.write(record)
+
+    def record_value(self, kind: int, value: int):
+        if self.file is not None:
+            self.write(VALUE_RECORD.pack(kind, self.micros(), value))
+
+    def write(self, record: bytes):
+        self.file.write(record)
+        self.written += len(record)
+        if self.max_bytes is not None and self.written >= self.max_bytes:
+            self.logger.warning("Capture file %s reached %d bytes, capture stopped", self.path, self.written)
+            self.close()
+
+    def flush(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        self.clock.callLater(FLUSH_SECONDS, self.flush)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path: str) -> Iterator[Tuple[int, float, object]]:
+    """
+    Yields (kind, seconds since the capture started, record) for every record in the file.
+    The record is (datagram, address) for datagrams and the value for the rest.
+    A record cut short at the end (e.g. the server was killed) ends the iteration
+    """
+    with open(path, "rb") as capture_file:
+        data = capture_file.read()
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a capture file this version can read")
+    offset = HEADER.size
+    while offset + RECORD_PREFIX.size <= len(data):
+        kind, micros = RECORD_PREFIX.unpack_from(data, offset)
+        if kind == KIND_DATAGRAM:
+            if offset + DATAGRAM_RECORD.size > len(data):
+                return
+            _, _, ip_length, port, length = DATAGRAM_RECORD.unpack_from(data, offset)
+            start = offset + DATAGRAM_RECORD.size
+            offset = start + ip_length + length
+            if offset > len(data):
+                return
+            record = (data[start + ip_length:offset], (unpack_ip(data[start:start + ip_length]), port))
+        else:
+            if offset + VALUE_RECORD.size > len(data):
+                return
+            record = VALUE_RECORD.unpack_from(data, offset)[2]
+            offset += VALUE_RECORD.size
+        yield kind, micros / 1e6, record
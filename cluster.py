@@ -0,0 +1,282 @@
+"""
+Cluster mode
+Several server instances share one session namespace. Every node owns the sessions that were
+created on it and gossips the names it owns to the other nodes over its own UDP port:
+claims and releases are sent as numbered deltas as soon as they happen, and a heartbeat with
+the last delta number goes out every second. A node that misses a delta, sees a peer restart
+or hears from it for the first time asks it for its whole list of names.
+Nodes use this to refuse hosting names owned elsewhere and to redirect requests for sessions
+living on another node to that node's client address. A name claimed by several nodes at the
+same time belongs to the one with the lowest node id, this node included.
+Gossip is only accepted from the configured peers and, with a shared secret, only if its
+HMAC matches, since it decides where clients are redirected to.
+The gossip socket is polled from the server clock so it runs the same on every engine
+"""
+
+import hashlib
+import hmac
+import json
+import random
+import socket
+from typing import Dict, List, Optional, Set, Tuple
+
+import logger
+
+GOSSIP_POLL_SECONDS: float = 0.05
+HEARTBEAT_SECONDS: float = 1
+PEER_TIMEOUT_SECONDS: float = 5
+BIND_RETRIES = 50
+BIND_RETRY_SECONDS = 0.1
+# Names per gossip datagram, so every datagram stays well under the MTU
+NAMES_PER_DATAGRAM = 64
+# With a shared secret every datagram starts with the HMAC-SHA256 of the rest
+MAC_SIZE = hashlib.sha256().digest_size
+
+
+class Peer:
+
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+        self.incarnation: Optional[int] = None
+        self.sequence: int = 0
+        self.names: Set[str] = set()
+        self.client_address: Optional[Tuple[str, int]] = None
+        self.last_heard: float = 0
+        self.sync_requested = False
+        # Parts of the full list being received: (incarnation, sequence, part count) and the parts
+        self.sync_id: Optional[Tuple] = None
+        self.sync_parts: Dict[int, List[str]] = {}
+
+
+class ClusterNode:
+
+    def __init__(self, server, gossip_port: int, peers: List[Tuple[str, int]], client_address: Tuple[str, int],
+                 secret: Optional[bytes] = None):
+        self.server = server
+        self.clock = server.clock
+        # Resolved once, datagrams from any other address are dropped
+        self.peers = [(socket.gethostbyname(host), port) for host, port in peers]
+        self.secret = secret
+        self.client_address = client_address
+        # The client address identifies the node, the incarnation tells its restarts apart
+        self.node_id = f"{client_address[0]}:{client_address[1]}"
+        self.incarnation = random.getrandbits(48)
+        self.sequence = 0
+        self.logger = logger.get_logger("Cluster")
+        # Gossip address -> what that node told us
+        self.known_peers: Dict[Tuple[str, int], Peer] = {}
+        # Session name -> node id owning it, for every session on other nodes
+        self.owners: Dict[str, str] = {}
+        self.client_addresses: Dict[str, Tuple[str, int]] = {}
+        # Names this node owns, sessions active or starting here
+        self.claimed: Set[str] = set()
+        # Claims ("+name") and releases ("-name") not sent yet, in the order they happened
+        self.pending_changes: List[str] = []
+        self.flush_call = None
+        self.socket = None
+        self.bind(gossip_port, BIND_RETRIES)
+
+    def bind(self, gossip_port: int, retries: int):
+        # On a hot restart the previous process may still hold the port for a moment
+        gossip_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            gossip_socket.bind(("", gossip_port))
+        except OSError as e:
+            gossip_socket.close()
+            if retries <= 0:
+                raise
+            self.logger.debug("Could not bind gossip port %s yet: %s", gossip_port, str(e))
+            self.clock.callLater(BIND_RETRY_SECONDS, self.bind, gossip_port, retries - 1)
+            return
+        gossip_socket.setblocking(False)
+        self.socket = gossip_socket
+        self.logger.info("Gossiping on *:%d with %s", gossip_port,
+                         ", ".join(f"{host}:{port}" for host, port in self.peers))
+        self.clock.callLater(GOSSIP_POLL_SECONDS, self.poll)
+        self.heartbeat()
+
+    def remote_owner(self, session_name: str) -> Optional[Tuple[str, int]]:
+        """
+        Client address of the node owning the session if it is another node, None otherwise
+        """
+        node_id = self.owners.get(session_name)
+        return self.client_addresses.get(node_id) if node_id is not None else None
+
+    def update(self, session_name: str, owned: bool):
+        """
+        Claims or releases the name if its ownership by this node changed
+        """
+        if owned == (session_name in self.claimed):
+            return
+        if owned:
+            self.claimed.add(session_name)
+            self.pending_changes.append("+" + session_name)
+        else:
+            self.claimed.discard(session_name)
+            self.pending_changes.append("-" + session_name)
+        self.resolve(session_name)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        # Everything claimed or released in the same loop iteration goes out together
+        if self.socket is None:
+            # The full list is sent to every peer once bound anyway
+            self.pending_changes = []
+            return
+        if self.flush_call is None or not self.flush_call.active():
+            self.flush_call = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        changes, self.pending_changes = self.pending_changes, []
+        for start in range(0, len(changes), NAMES_PER_DATAGRAM):
+            self.sequence += 1
+            self.broadcast({"t": "delta", "s": self.sequence, "c": changes[start:start + NAMES_PER_DATAGRAM]})
+
+    def heartbeat(self):
+        self.broadcast({"t": "heartbeat", "s": self.sequence})
+        self.expire_peers()
+        self.clock.callLater(HEARTBEAT_SECONDS, self.heartbeat)
+
+    """
+    Gossip sending and receiving
+    """
+    def broadcast(self, message: dict):
+        for peer in self.peers:
+            self.send(peer, message)
+
+    def send(self, address: Tuple[str, int], message: dict):
+        message.update({"n": self.node_id, "i": self.incarnation, "a": self.client_address})
+        payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+        if self.secret is not None:
+            payload = hmac.new(self.secret, payload, hashlib.sha256).digest() + payload
+        try:
+            self.socket.sendto(payload, address)
+        except OSError as e:
+            self.logger.debug("Could not gossip to %s:%s: %s", address[0], address[1], str(e))
+
+    def poll(self):
+        while True:
+            try:
+                datagram, address = self.socket.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # e.g. ICMP port unreachable from a peer that is down
+                self.logger.debug("Gossip socket error: %s", str(e))
+                continue
+            if address not in self.peers:
+                self.logger.debug("Dropped gossip from %s:%s, not a cluster peer", address[0], address[1])
+                continue
+            if self.secret is not None:
+                mac, datagram = datagram[:MAC_SIZE], datagram[MAC_SIZE:]
+                if not hmac.compare_digest(mac, hmac.new(self.secret, datagram, hashlib.sha256).digest()):
+                    self.logger.debug("Dropped gossip from %s:%s, wrong HMAC", address[0], address[1])
+                    continue
+            try:
+                self.handle(json.loads(datagram), address)
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.debug("Invalid gossip from %s:%s: %s", address[0], address[1], str(e))
+        self.clock.callLater(GOSSIP_POLL_SECONDS, self.poll)
+
+    def handle(self, message: dict, address: Tuple[str, int]):
+        peer = self.known_peers.get(address)
+        if peer is None or peer.node_id != message["n"]:
+            if peer is not None:
+                self.forget(peer)
+            peer = self.known_peers[address] = Peer(message["n"])
+        peer.last_heard = self.clock.seconds()
+        ip, port = message["a"]
+        if not isinstance(ip, str) or not isinstance(port, int):
+            raise TypeError(f"Invalid client address {message['a']}")
+        peer.client_address = (ip, port)
+        self.client_addresses[peer.node_id] = peer.client_address
+        message_type = message["t"]
+        if message_type == "sync":
+            self.send_names(address)
+            return
+        if message["i"] != peer.incarnation:
+            # New or restarted node, whatever it owned before is gone
+            self.forget(peer)
+            peer.incarnation = message["i"]
+            peer.sequence = None
+        if message_type == "names":
+            self.receive_names(peer, message)
+        elif message_type == "delta" and peer.sequence is not None and message["s"] == peer.sequence + 1:
+            peer.sequence = message["s"]
+            for change in message["c"]:
+                if change[0] == "+":
+                    self.own(peer, change[1:])
+                else:
+                    self.disown(peer, change[1:])
+        elif message["s"] != peer.sequence and (message_type == "heartbeat" or not peer.sync_requested):
+            # Missed deltas (or never synced), ask for the whole list. Heartbeats ask again in case it got lost
+            self.send(address, {"t": "sync"})
+            peer.sync_requested = True
+
+    def send_names(self, address: Tuple[str, int]):
+        names = list(self.claimed)
+        parts = max(1, -(-len(names) // NAMES_PER_DATAGRAM))
+        for part in range(parts):
+            self.send(address, {"t": "names", "s": self.sequence, "p": part, "pc": parts,
+                                "c": names[part * NAMES_PER_DATAGRAM:(part + 1) * NAMES_PER_DATAGRAM]})
+
+    def receive_names(self, peer: Peer, message: dict):
+        sync_id = (message["i"], message["s"], message["pc"])
+        if peer.sync_id != sync_id:
+            peer.sync_id = sync_id
+            peer.sync_parts = {}
+        peer.sync_parts[message["p"]] = message["c"]
+        if len(peer.sync_parts) < message["pc"]:
+            return
+        self.forget(peer)
+        for names in peer.sync_parts.values():
+            for name in names:
+                self.own(peer, name)
+        peer.sequence = message["s"]
+        peer.sync_requested = False
+        peer.sync_id = None
+        peer.sync_parts = {}
+        self.logger.info("Synced %s sessions from node %s", len(peer.names), peer.node_id)
+
+    """
+    Ownership bookkeeping
+    """
+    def own(self, peer: Peer, name: str):
+        if name not in peer.names and (name in self.claimed or name in self.owners):
+            self.logger.warning("Session %s exists on several nodes", name)
+        peer.names.add(name)
+        self.resolve(name)
+
+    def disown(self, peer: Peer, name: str):
+        peer.names.discard(name)
+        self.resolve(name)
+
+    def forget(self, peer: Peer):
+        names, peer.names = peer.names, set()
+        for name in names:
+            self.resolve(name)
+
+    def resolve(self, name: str):
+        """
+        Gives the name to the lowest node id claiming it, this node included, and keeps it
+        in owners only if that node is another one
+        """
+        owner = min((peer.node_id for peer in self.known_peers.values() if name in peer.names), default=None)
+        if owner is not None and name in self.claimed and self.node_id < owner:
+            owner = None
+        if self.owners.get(name) == owner:
+            return
+        if owner is None:
+            del self.owners[name]
+        else:
+            self.owners[name] = owner
+        # Cached replies to requests for this name may be the ones of a local session or none
+        self.server.response_cache.invalidate(name)
+
+    def expire_peers(self):
+        now = self.clock.seconds()
+        for address, peer in list(self.known_peers.items()):
+            if now - peer.last_heard > PEER_TIMEOUT_SECONDS:
+                self.logger.info("Node %s timed out, dropping its %s sessions", peer.node_id, len(peer.names))
+                self.forget(peer)
+                del self.known_peers[address]
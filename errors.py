@@ -17,3 +17,10 @@ ERR_SESSION_PLAYER_EXIT = "error:player_exited_session"
 ERR_SESSION_NOT_STARTED = "error:session_not_started"
 ERR_SESSION_TIMEOUT = "error:session_timeout"
 ERR_PLAYER_TIMEOUT = "error:player_timeout"
+
+# Binary protocol clients receive the index of the error in this tuple
+# Order matters, new error codes must be appended at the end
+ERROR_CODES = (ERR_REQUEST_INVALID, ERR_SESSION_EXISTS, ERR_SESSION_NON_EXISTENT, ERR_SESSION_PASSWORD_MISMATCH,
+               ERR_SESSION_SINGLE_PLAYER, ERR_SESSION_FULL, ERR_SESSION_PLAYER_NAME_IN_USE,
+               ERR_SESSION_PLAYER_NON_EXISTENT, ERR_SESSION_PLAYER_NON_HOST, ERR_SESSION_PLAYER_KICKED_BY_HOST,
+               ERR_SESSION_PLAYER_EXIT, ERR_SESSION_NOT_STARTED, ERR_SESSION_TIMEOUT, ERR_PLAYER_TIMEOUT)
@@ -0,0 +1,59 @@
+"""
+Expiry index used by the server to find timed out players and sessions
+without scanning every session on each cleanup pass
+It is a lazy-deletion min heap: each key is pushed once with the deadline it had
+when it was added and, when popped, its real deadline is asked again to the owner.
+Keys that no longer exist are dropped and keys whose deadline moved forward
+(e.g. a player that pinged) are pushed back, so refreshing a deadline costs nothing
+"""
+
+import heapq
+from typing import Callable, Dict, Hashable, List, Optional
+
+
+class ExpiryIndex:
+
+    def __init__(self, deadline_of: Callable[[Hashable], Optional[int]]):
+        # deadline_of returns the current deadline for a key or None if the key is gone
+        self.deadline_of = deadline_of
+        self.heap: List = []
+        self.scheduled: Dict[Hashable, int] = {}
+        self.counter: int = 0
+
+    def add(self, key: Hashable, deadline: int) -> bool:
+        """
+        Tracks the key. Returns True if this deadline is now the earliest one,
+        so the caller knows it has to reschedule its timer
+        """
+        if key in self.scheduled:
+            return False
+        self.push(key, deadline)
+        return self.heap[0][2] == key
+
+    def next_deadline(self) -> Optional[int]:
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_expired(self, now: int) -> List[Hashable]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, key = heapq.heappop(self.heap)
+            del self.scheduled[key]
+            deadline = self.deadline_of(key)
+            if deadline is None:
+                continue
+            if deadline <= now:
+                expired.append(key)
+            else:
+                self.push(key, deadline)
+        return expired
+
+    def push(self, key: Hashable, deadline: int):
+        # The counter avoids comparing keys when two deadlines are equal
+        self.counter += 1
+        self.scheduled[key] = deadline
+        heapq.heappush(self.heap, (deadline, self.counter, key))
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,186 @@
+"""
+Hot restart
+A server started with --hot-restart listens on a local unix socket for its successor.
+When a new process is started with --hot-restart on the same port, it connects to that
+socket and the old process, in a single event loop callback, takes a snapshot of every
+session, sends it together with the UDP socket descriptor (SCM_RIGHTS), stops reading and
+exits. Datagrams arriving meanwhile wait in the socket buffer, which both processes share,
+so nothing is lost and the new process resumes from the snapshot with its timers rebuilt
+"""
+
+import base64
+import json
+import math
+import os
+import socket
+import struct
+import zlib
+from typing import Optional, Tuple
+
+import logger
+from model import Player, Session, current_time_millis
+from retransmit import RetryPolicy
+from server import SECONDS_BETWEEN_CONFIRMATION_RETRIES
+
+HOT_RESTART_SOCKET_DIR = "/tmp"
+HOT_RESTART_POLL_SECONDS: float = 0.1
+# Timestamps travel as ages in milliseconds, so the clocks of both processes do not need to agree
+SNAPSHOT_VERSION = 2
+
+# The snapshot length travels with the socket descriptor, the snapshot follows it
+LENGTH = struct.Struct("!Q")
+
+
+def control_socket_path(port: int) -> str:
+    return os.path.join(HOT_RESTART_SOCKET_DIR, f"rabid-hole-punch-{port}.restart")
+
+
+def take_over(port: int) -> Optional[Tuple[socket.socket, bytes]]:
+    """
+    Asks the process currently serving the port for its UDP socket and state.
+    Returns None if there is no such process
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(control_socket_path(port))
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+    with client:
+        header, fds, _, _ = socket.recv_fds(client, LENGTH.size, 1)
+        if len(header) != LENGTH.size or not fds:
+            raise RuntimeError("Invalid hot restart handoff")
+        (length,) = LENGTH.unpack(header)
+        chunks = []
+        received = 0
+        while received < length:
+            chunk = client.recv(min(length - received, 1 << 20))
+            if not chunk:
+                raise RuntimeError("Hot restart snapshot truncated")
+            chunks.append(chunk)
+            received += len(chunk)
+    return socket.socket(fileno=fds[0]), b"".join(chunks)
+
+
+class HotRestartHandoff:
+
+    def __init__(self, port: int, server, listener, stop_engine):
+        self.server = server
+        self.listener = listener
+        self.stop_engine = stop_engine
+        self.logger = logger.get_logger("HotRestart")
+        path = control_socket_path(port)
+        # Only the process binding the path removes it, the old one must not unlink the new one's
+        if os.path.exists(path):
+            os.unlink(path)
+        self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control.bind(path)
+        self.control.listen(1)
+        self.control.setblocking(False)
+        self.server.clock.callLater(HOT_RESTART_POLL_SECONDS, self.poll)
+
+    def poll(self):
+        try:
+            connection, _ = self.control.accept()
+        except BlockingIOError:
+            self.server.clock.callLater(HOT_RESTART_POLL_SECONDS, self.poll)
+            return
+        # Everything below runs in this callback so no datagram is handled after the snapshot
+        with connection:
+            connection.setblocking(True)
+            snapshot = take_snapshot(self.server)
+            socket.send_fds(connection, [LENGTH.pack(len(snapshot))], [self.listener.fileno()])
+            connection.sendall(snapshot)
+        self.listener.stop()
+        self.control.close()
+        self.logger.info("Handed over %s active and %s starting sessions to the new process",
+                         len(self.server.active_sessions), len(self.server.starting_sessions))
+        self.stop_engine()
+
+
+def take_snapshot(server) -> bytes:
+    now = server.clock.seconds()
+    now_millis = current_time_millis()
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "active": [encode_session(session, now_millis) for session in server.active_sessions.values()],
+        "starting": [encode_session(session, now_millis) + [max(0.0, server.starting_closes_at[name] - now),
+                                                encode_start_payloads(server, session)]
+                     for name, session in server.starting_sessions.items()],
+    }
+    return zlib.compress(json.dumps(snapshot, separators=(",", ":")).encode("utf-8"))
+
+
+def encode_session(session: Session, now_millis: int) -> list:
+    # The host is always the first player
+    return [session.name, session.max_players, session.password, now_millis - session.started_at,
+            [[player.name, player.ip, player.port, player.binary, now_millis - player.last_seen, player.token,
+              player.versioned]
+             for player in session.players.values()]]
+
+
+def encode_start_payloads(server, session: Session) -> dict:
+    # Start messages are the ones built when the session started, rebuilding them now would
+    # leave out the players that already confirmed
+    return {player.name: base64.b64encode(server.start_payloads[(session.name, player.name)]).decode("ascii")
+            for player in session.players.values()}
+
+
+def decode_session(encoded: list, now_millis: int) -> Session:
+    # Ages in the snapshot are turned into times of the local clock
+    name, max_players, password, started_at, players = encoded[:5]
+    decoded_players = []
+    for player_name, ip, port, binary, last_seen, token, versioned in players:
+        player = Player(player_name, ip, port, binary)
+        player.last_seen = now_millis - last_seen
+        player.token = token
+        player.versioned = versioned
+        decoded_players.append(player)
+    session = Session(name, max_players, decoded_players[0], password)
+    session.started_at = now_millis - started_at
+    for player in decoded_players[1:]:
+        session.add_player(player)
+    return session
+
+
+def restore_players(server, session: Session):
+    for player in session.players.values():
+        server.index_player(player)
+
+
+def restore_snapshot(server, data: bytes):
+    """
+    Loads the sessions of the snapshot into the server and rebuilds the timers:
+    expiry tracking for active sessions, start message retries and closing for starting ones.
+    The server must already have its transport
+    """
+    snapshot = json.loads(zlib.decompress(data).decode("utf-8"))
+    if snapshot["version"] != SNAPSHOT_VERSION:
+        raise RuntimeError(f"Unsupported hot restart snapshot version {snapshot['version']}")
+    now_millis = current_time_millis()
+    for encoded in snapshot["active"]:
+        session = decode_session(encoded, now_millis)
+        restore_players(server, session)
+        server.active_sessions[session.name] = session
+        server.track_session(session.name)
+        server.session_changed(session)
+        for player in session.players.values():
+            server.track_player(session.name, player.name)
+    for encoded in snapshot["starting"]:
+        session = decode_session(encoded, now_millis)
+        restore_players(server, session)
+        remaining, payloads = encoded[5:7]
+        server.starting_sessions[session.name] = session
+        server.starting_closes_at[session.name] = server.clock.seconds() + remaining
+        server.session_changed(session)
+        server.clock.callLater(remaining, server.close_starting_session, session.name)
+        # Only the tries that were left are sent
+        policy = RetryPolicy(max(1, math.ceil(remaining / SECONDS_BETWEEN_CONFIRMATION_RETRIES)),
+                             SECONDS_BETWEEN_CONFIRMATION_RETRIES)
+        for player_name, payload in payloads.items():
+            player = session.players[player_name]
+            server.start_payloads[(session.name, player_name)] = base64.b64decode(payload)
+            server.retransmits.send(player.address, server.start_payloads[(session.name, player_name)], policy,
+                                    (session.name, player_name))
+    logger.get_logger("HotRestart").info("Restored %s active and %s starting sessions",
+                                         len(snapshot["active"]), len(snapshot["starting"]))
@@ -0,0 +1,145 @@
+"""
+Socket ingress tuning
+Bursts of requests the server does not read fast enough overflow the socket receive buffer,
+and the kernel drops them without anybody noticing. This sets the socket buffer sizes, can
+read many datagrams per wakeup of the event loop instead of leaving it to the engine, and
+reports what the kernel dropped next to the server's own counters, so a slow server and an
+overflowing socket can be told apart.
+Python has no recvmmsg, so a batch is a loop of non blocking recvmsg calls until the socket
+is empty or the batch is full. Kernel drops come from /proc/net/udp, which counts them since
+the socket was created, and in batched mode also from SO_RXQ_OVFL, which tags the datagrams
+read with the drop count of the socket
+"""
+
+import os
+import socket
+import struct
+import sys
+from typing import Dict, Optional, Tuple
+
+import logger
+
+# Bytes, None keeps the system default. Linux doubles the value and caps it to net.core.rmem_max / wmem_max
+RECEIVE_BUFFER_BYTES: Optional[int] = None
+SEND_BUFFER_BYTES: Optional[int] = None
+# Datagrams read per wakeup, 0 leaves reading to the engine
+READ_BATCH: int = 0
+
+MAX_DATAGRAM_BYTES = 65535
+# Linux value, the socket module does not export it
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+DROP_COUNT = struct.Struct("=I")
+PROC_NET_UDP = ("/proc/net/udp", "/proc/net/udp6")
+
+
+class Ingress:
+
+    def __init__(self, udp_socket: socket.socket, server):
+        self.socket = udp_socket
+        self.server = server
+        self.logger = logger.get_logger("Ingress")
+        # Identifies the socket in /proc/net/udp, it is the same for every duplicate of the descriptor
+        self.inode = os.fstat(udp_socket.fileno()).st_ino
+        self.batched = READ_BATCH > 0
+        self.overflow_enabled = False
+        # Drop count of the socket as of the last datagram read, from SO_RXQ_OVFL
+        self.overflow_drops: int = 0
+        self.read_batches: int = 0
+        self.send_buffer_full: int = 0
+        self.configure()
+        self.add_metrics(server.metrics)
+
+    def configure(self):
+        if RECEIVE_BUFFER_BYTES is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+        if SEND_BUFFER_BYTES is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        if self.batched and sys.platform.startswith("linux"):
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self.overflow_enabled = True
+            except OSError as e:
+                self.logger.warning("Could not enable SO_RXQ_OVFL: %s", str(e))
+        self.logger.info("Socket buffers: %d bytes to receive, %d bytes to send, %s",
+                         self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                         self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                         f"reading up to {READ_BATCH} datagrams per wakeup" if self.batched else "engine reads")
+
+    def add_metrics(self, metrics):
+        metrics.add_counters("kernel_drops_total", "Datagrams dropped by the kernel before the server read them",
+                             self.kernel_drops, "source")
+        metrics.add_counters("send_buffer_full_total", "Replies dropped because the socket send buffer was full",
+                             lambda: {"": self.send_buffer_full}, None)
+        metrics.add_counters("read_batches_total", "Wakeups reading datagrams in batched mode",
+                             lambda: {"": self.read_batches}, None)
+        metrics.add_gauge("socket_receive_queue_bytes", "Bytes waiting in the socket receive buffer",
+                          lambda: (self.proc_counters() or (0, 0))[0])
+        metrics.add_gauge("socket_receive_buffer_bytes", "Size of the socket receive buffer",
+                          lambda: self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+    def kernel_drops(self) -> Dict[str, int]:
+        drops = {}
+        counters = self.proc_counters()
+        if counters is not None:
+            drops["proc"] = counters[1]
+        if self.overflow_enabled:
+            drops["rxq_ovfl"] = self.overflow_drops
+        return drops
+
+    def proc_counters(self) -> Optional[Tuple[int, int]]:
+        """
+        Bytes in the receive queue and datagrams dropped of the socket, None if it is not found
+        """
+        for path in PROC_NET_UDP:
+            try:
+                with open(path) as proc_file:
+                    lines = proc_file.readlines()[1:]
+            except OSError:
+                continue
+            for line in lines:
+                # sl local rem st tx_queue:rx_queue tr:when retrnsmt uid timeout inode ref pointer drops
+                fields = line.split()
+                if len(fields) >= 13 and int(fields[9]) == self.inode:
+                    return int(fields[4].split(":")[1], 16), int(fields[12])
+        return None
+
+    def read(self):
+        """
+        Reads and handles datagrams until the socket is empty or the batch is full.
+        Called by the engine when the socket is readable
+        """
+        self.read_batches += 1
+        receive = self.socket.recvmsg
+        handle = self.server.datagramReceived
+        ancillary_size = socket.CMSG_SPACE(DROP_COUNT.size) if self.overflow_enabled else 0
+        for _ in range(READ_BATCH):
+            try:
+                datagram, ancillary, _, address = receive(MAX_DATAGRAM_BYTES, ancillary_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable for a previous reply
+                self.logger.debug("Socket error: %s", str(e))
+                continue
+            for level, kind, data in ancillary:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= DROP_COUNT.size:
+                    self.overflow_drops = DROP_COUNT.unpack_from(data)[0]
+            handle(datagram, address)
+
+    def write(self, payload: bytes, address: Tuple):
+        # Transport of the server in batched mode
+        try:
+            self.socket.sendto(payload, address)
+        except BlockingIOError:
+            self.send_buffer_full += 1
+        except ConnectionRefusedError:
+            pass
+
+    def write_vectored(self, parts: Tuple, address: Tuple):
+        # Sends the parts as one datagram without joining them first, used by the relay
+        try:
+            self.socket.sendmsg(parts, (), 0, address)
+        except BlockingIOError:
+            self.send_buffer_full += 1
+        except ConnectionRefusedError:
+            pass
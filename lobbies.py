@@ -0,0 +1,98 @@
+"""
+Index of the sessions players can join, used to answer list requests
+Sessions are kept in sorted lists that the server updates whenever a session is
+created, gains or loses players or goes away, so a list request only slices a page
+out of them instead of scanning every session.
+There is one list per order and visibility (every joinable session or only the ones
+without password), inserting and removing is a binary search plus a list memmove
+"""
+
+from bisect import bisect_left, insort
+from typing import Dict, List, Tuple
+
+import protocol
+from model import Session
+
+ORDER_FREE_SLOTS = "f"
+ORDER_AGE = "a"
+ORDERS = (ORDER_FREE_SLOTS, ORDER_AGE)
+
+# Replies must fit in one datagram without IP fragmentation on any usual path
+LIST_MAX_DATAGRAM_BYTES = 1200
+# Worst case text entry "<session>:<players>:<max>:<locked>;" and header "l:<page>:<pages>:"
+LIST_ENTRY_MAX_BYTES = 10 + 1 + 2 + 1 + 2 + 1 + 1 + 1
+LIST_HEADER_MAX_BYTES = 2 + 5 + 1 + 5 + 1
+LIST_MAX_PAGES = 65535
+PAGE_SIZE = (LIST_MAX_DATAGRAM_BYTES - LIST_HEADER_MAX_BYTES) // LIST_ENTRY_MAX_BYTES
+
+
+class LobbyIndex:
+
+    def __init__(self):
+        # (order, only sessions without password) -> sorted list of keys.
+        # Keys end with the session name, which is unique, and the session itself
+        self.sorted: Dict[Tuple[str, bool], List[Tuple]] = {(order, open_only): []
+                                                             for order in ORDERS for open_only in (False, True)}
+        # Session name -> its key in the free slots order as currently stored, the rest can be derived from it
+        self.indexed: Dict[str, Tuple] = {}
+
+    def update(self, session: Session):
+        """
+        Indexes the session as it is now, or drops it if it cannot be joined anymore.
+        Must be called after every change in the players of an active session
+        """
+        if session.is_full() or not session.players:
+            self.remove(session.name)
+            return
+        key = (len(session.players) - session.max_players, session.started_at, session.name, session)
+        indexed = self.indexed.get(session.name)
+        if indexed is not None and indexed[0] == key[0] and indexed[3] is session:
+            return
+        self.remove(session.name)
+        self.insert(key)
+        self.indexed[session.name] = key
+
+    def remove(self, session_name: str):
+        key = self.indexed.pop(session_name, None)
+        if key is not None:
+            self.insert(key, delete=True)
+
+    def insert(self, key: Tuple, delete: bool = False):
+        # Adds or deletes the key of a session in every list it belongs to
+        locked = key[3].password is not None
+        for order, order_key in ((ORDER_FREE_SLOTS, key), (ORDER_AGE, key[1:])):
+            for open_only in (False, True):
+                if open_only and locked:
+                    continue
+                if delete:
+                    self.delete_key(self.sorted[(order, open_only)], order_key)
+                else:
+                    insort(self.sorted[(order, open_only)], order_key)
+
+    @staticmethod
+    def delete_key(keys: List[Tuple], key: Tuple):
+        del keys[bisect_left(keys, key)]
+
+    def page(self, order: str, page: int, open_only: bool = False) -> Tuple[List[Session], int]:
+        """
+        Returns the sessions in the given page and the number of pages, which is at least 1
+        """
+        keys = self.sorted[(order, open_only)]
+        pages = min(LIST_MAX_PAGES, max(1, -(-len(keys) // PAGE_SIZE)))
+        start = page * PAGE_SIZE
+        return [key[-1] for key in keys[start:start + PAGE_SIZE]], pages
+
+    def get_page_payload(self, order: str, page: int, open_only: bool = False, binary: bool = False) -> bytes:
+        sessions, pages = self.page(order, page, open_only)
+        entries = [(session.name, len(session.players), session.max_players, session.password is not None)
+                   for session in sessions]
+        if binary:
+            return protocol.encode_list(page, pages, entries)
+        message = f"l:{page}:{pages}"
+        if entries:
+            message += ":" + ";".join(f"{name}:{players}:{max_players}:{int(locked)}"
+                                      for name, players, max_players, locked in entries)
+        return bytes(message, "utf-8")
+
+    def __len__(self):
+        return len(self.indexed)
@@ -4,32 +4,90 @@ This file provides some helping config to have a nice logging
 mechanism that is easy to use in other parts of the code
 By default logs printed with this logger will be output to console
 and a rotating log file
+Records are put in a bounded queue and written by a background thread, so
+logging never blocks the reactor on disk I/O. If the queue is full records are
+dropped and counted instead of waiting
 """
 
+import atexit
+import json
 import logging
+import queue
 from logging import Logger
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 LOG_FILE_NAME = "rabid-hole-punch.log"
 LOG_MAX_BYTES = 10000000  # 10 MB
 LOG_BACKUP_COUNT = 10
 LOG_LEVEL = logging.INFO
+LOG_QUEUE_SIZE = 10000
+LOG_JSON = False
+
+log_queue = None
+listener = None
+dropped_records = 0
+
+
+class DroppingQueueHandler(QueueHandler):
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record) -> str:
+        entry = {"time": self.formatTime(record), "name": record.name, "level": record.levelname,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
 
 def get_logger(logger_name: str) -> Logger:
     logger = logging.getLogger(logger_name)
     logger.setLevel(LOG_LEVEL)
+    if logger.handlers:
+        return logger
 
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    qh = DroppingQueueHandler(get_log_queue())
+    qh.setLevel(LOG_LEVEL)
+    logger.addHandler(qh)
+
+    return logger
+
+
+def get_log_queue() -> queue.Queue:
+    # The queue and its writer thread are created on first use so the settings
+    # changed from main (level, file name, json) are the ones applied
+    global log_queue, listener
+    if log_queue is not None:
+        return log_queue
+
+    if LOG_JSON:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     ch = logging.StreamHandler()
     ch.setLevel(LOG_LEVEL)
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
 
     rf = RotatingFileHandler(LOG_FILE_NAME, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
     rf.setLevel(LOG_LEVEL)
     rf.setFormatter(formatter)
-    logger.addHandler(rf)
 
-    return logger
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(log_queue, ch, rf, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return log_queue
+
+
+def is_debug_enabled() -> bool:
+    # Hot paths check this once and skip building debug arguments when it is False
+    return LOG_LEVEL <= logging.DEBUG
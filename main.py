@@ -1,25 +1,218 @@
 """
 Main file of the UDP Hole Puncher Server
 You can activate debug mode by calling the main method with 'DEBUG' as the second parameter
+Run it with --help to see the rest of the options
 """
-import sys
+import argparse
+import atexit
+import functools
+import importlib
 import logging
+import capture
+import hotrestart
+import ingress
+import natprobe
+import overload
+import relay
 import logger
-from twisted.internet import reactor
-from server import Server
+import server
+
+METRICS_BIND_RETRIES = 50
+METRICS_BIND_RETRY_SECONDS = 0.1
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Rabid Hole Punch Server")
+    parser.add_argument("port", type=int, help="UDP port to listen on")
+    parser.add_argument("debug", nargs="?", choices=["DEBUG"], help="print debug information")
+    parser.add_argument("--engine", choices=["twisted", "asyncio"], default="twisted",
+                        help="event loop running the server")
+    parser.add_argument("--json-logs", action="store_true", help="write logs as JSON lines")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="disable per source rate limiting (e.g. for benchmarks)")
+    parser.add_argument("--rate-limit-by-ip", action="store_true",
+                        help="rate limit whole IPs, with a bigger budget, instead of (ip, port) addresses")
+    parser.add_argument("--no-load-shedding", action="store_true",
+                        help="handle every request even when the event loop falls behind")
+    parser.add_argument("--max-lag", type=float, default=None, metavar="MS",
+                        help="event loop lag in milliseconds over which pings from healthy players and replies to "
+                             "invalid requests are shed (default %d)" % (overload.MAX_LAG_SECONDS * 1000))
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on this local TCP port (plus the worker index with --workers)")
+    parser.add_argument("--receive-buffer", type=int, default=None, metavar="BYTES",
+                        help="size of the socket receive buffer (SO_RCVBUF), system default if not given")
+    parser.add_argument("--send-buffer", type=int, default=None, metavar="BYTES",
+                        help="size of the socket send buffer (SO_SNDBUF), system default if not given")
+    parser.add_argument("--read-batch", type=int, default=0, metavar="N",
+                        help="read up to N datagrams per event loop wakeup instead of letting the engine read")
+    parser.add_argument("--capture", default=None, metavar="FILE",
+                        help="record received traffic to FILE (plus .worker-<n> with --workers) "
+                             "to replay it with benchmarks/replay.py")
+    parser.add_argument("--relay", action="store_true",
+                        help="relay traffic between players of started sessions that cannot reach each other")
+    parser.add_argument("--relay-bandwidth", type=int, default=None, metavar="BYTES",
+                        help="bytes per second all the players of a session can relay together")
+    parser.add_argument("--probe-ports", type=parse_ports, default=[],
+                        help="comma separated extra UDP ports clients ping to tell the server how their NAT maps "
+                             "ports, used to predict the port of every peer in the start message")
+    parser.add_argument("--hot-restart", action="store_true",
+                        help="take over the socket and sessions of the server running on the same port, if any, "
+                             "and let the next process started with this option do the same")
+    parser.add_argument("--cluster-port", type=int, default=None,
+                        help="join a cluster of servers, gossiping session names on this UDP port")
+    parser.add_argument("--cluster-peers", type=parse_addresses, default=[],
+                        help="comma separated host:port gossip addresses of the other nodes of the cluster")
+    parser.add_argument("--cluster-address", default="127.0.0.1",
+                        help="IP address clients use to reach this node, sent to them in redirects")
+    parser.add_argument("--cluster-secret", default=None,
+                        help="secret shared by the nodes of the cluster, gossip without its HMAC is dropped")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port (Linux and twisted engine only)")
+    parser.add_argument("--worker-index", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-channels", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and args.engine != "twisted":
+        parser.error("--workers is only supported with the twisted engine")
+    if args.workers > 1 and args.hot_restart:
+        parser.error("--hot-restart is not supported with --workers")
+    if args.workers > 1 and args.cluster_port is not None:
+        parser.error("--cluster-port is not supported with --workers")
+    if args.workers > 1 and args.probe_ports:
+        parser.error("--probe-ports is not supported with --workers")
+    return args
+
+
+def parse_addresses(addresses: str) -> list:
+    parsed = []
+    for address in filter(None, addresses.split(",")):
+        host, _, port = address.rpartition(":")
+        if not host or not port.isdigit():
+            raise argparse.ArgumentTypeError(f"invalid address {address}, it must be host:port")
+        parsed.append((host, int(port)))
+    return parsed
+
+
+def parse_ports(ports: str) -> list:
+    parsed = []
+    for port in filter(None, ports.split(",")):
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise argparse.ArgumentTypeError(f"invalid port {port}")
+        parsed.append(int(port))
+    return parsed
+
+
+def listen_probe(engine, port: int, index: int, hole_punch_server, retries: int = METRICS_BIND_RETRIES):
+    # On a hot restart the previous process may still hold the port for a moment
+    try:
+        engine.listen_probe(port, functools.partial(hole_punch_server.probe_received, index))
+        logger.get_logger("Main").info('Listening for probes on *:%d' % port)
+    except Exception as e:
+        if retries <= 0:
+            logger.get_logger("Main").error("Could not listen for probes on port %d: %s", port, str(e))
+            return
+        hole_punch_server.clock.callLater(METRICS_BIND_RETRY_SECONDS, listen_probe, engine, port, index,
+                                          hole_punch_server, retries - 1)
+
+
+def serve_metrics(engine, port: int, hole_punch_server, retries: int = METRICS_BIND_RETRIES):
+    # On a hot restart the previous process may still hold the port for a moment
+    try:
+        engine.serve_metrics(port, hole_punch_server.metrics)
+        logger.get_logger("Main").info('Serving metrics on 127.0.0.1:%d' % port)
+    except Exception as e:
+        if retries <= 0:
+            logger.get_logger("Main").error("Could not serve metrics on port %d: %s", port, str(e))
+            return
+        hole_punch_server.clock.callLater(METRICS_BIND_RETRY_SECONDS, serve_metrics, engine, port,
+                                          hole_punch_server, retries - 1)
+
+
+def worker_arguments(args) -> list:
+    # Options every worker process has to be started with
+    worker_args = [args.debug] if args.debug else []
+    if args.json_logs:
+        worker_args.append("--json-logs")
+    if args.no_rate_limit:
+        worker_args.append("--no-rate-limit")
+    if args.rate_limit_by_ip:
+        worker_args.append("--rate-limit-by-ip")
+    if args.no_load_shedding:
+        worker_args.append("--no-load-shedding")
+    if args.max_lag is not None:
+        worker_args += ["--max-lag", str(args.max_lag)]
+    if args.metrics_port is not None:
+        worker_args += ["--metrics-port", str(args.metrics_port)]
+    if args.receive_buffer is not None:
+        worker_args += ["--receive-buffer", str(args.receive_buffer)]
+    if args.send_buffer is not None:
+        worker_args += ["--send-buffer", str(args.send_buffer)]
+    if args.read_batch:
+        worker_args += ["--read-batch", str(args.read_batch)]
+    if args.capture is not None:
+        worker_args += ["--capture", args.capture]
+    if args.relay:
+        worker_args.append("--relay")
+    if args.relay_bandwidth is not None:
+        worker_args += ["--relay-bandwidth", str(args.relay_bandwidth)]
+    return worker_args
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: ./main.py <port>")
-        print("Run with debug: ./main.py <port> DEBUG")
-        sys.exit(1)
+    args = parse_arguments()
 
-    if len(sys.argv) > 2 and sys.argv[2] == "DEBUG":
+    if args.debug == "DEBUG":
         print("+-+-+-+ Debug mode activated +-+-+-+")
         logger.LOG_LEVEL = logging.DEBUG
+    logger.LOG_JSON = args.json_logs
+    server.RATE_LIMIT_ENABLED = not args.no_rate_limit
+    server.RATE_LIMIT_BY_IP = args.rate_limit_by_ip
+    server.LOAD_SHEDDING_ENABLED = not args.no_load_shedding
+    if args.max_lag is not None:
+        overload.MAX_LAG_SECONDS = args.max_lag / 1000
+    ingress.RECEIVE_BUFFER_BYTES = args.receive_buffer
+    ingress.SEND_BUFFER_BYTES = args.send_buffer
+    ingress.READ_BATCH = args.read_batch
+    natprobe.PROBE_PORTS = args.probe_ports
+    server.RELAY_ENABLED = args.relay
+    if args.relay_bandwidth is not None:
+        relay.RELAY_BYTES_PER_SECOND = args.relay_bandwidth
 
-    port = int(sys.argv[1])
-    reactor.listenUDP(port, Server())
-    logger.get_logger("Main").info('Listening on *:%d' % port)
-    reactor.run()
+    if args.workers > 1 and args.worker_index is None:
+        import workers
+        workers.run_supervisor(args.port, args.workers, worker_arguments(args))
+    else:
+        if args.worker_index is not None:
+            logger.LOG_FILE_NAME = f"rabid-hole-punch.worker-{args.worker_index}.log"
+        # Engines are imported on demand so the asyncio one does not load twisted
+        engine = importlib.import_module(f"{args.engine}_engine")
+        hole_punch_server = engine.create_server()
+        if args.capture is not None:
+            capture_file = args.capture if args.worker_index is None else f"{args.capture}.worker-{args.worker_index}"
+            hole_punch_server.capture = capture.CaptureWriter(capture_file, hole_punch_server.clock, capture.MAX_BYTES)
+            atexit.register(hole_punch_server.capture.close)
+            logger.get_logger("Main").info("Capturing traffic to %s", capture_file)
+        if args.cluster_port is not None:
+            import cluster
+            secret = args.cluster_secret.encode("utf-8") if args.cluster_secret is not None else None
+            hole_punch_server.cluster = cluster.ClusterNode(hole_punch_server, args.cluster_port, args.cluster_peers,
+                                                            (args.cluster_address, args.port), secret)
+        handoff = hotrestart.take_over(args.port) if args.hot_restart else None
+        if args.worker_index is not None:
+            import workers
+            workers.listen_worker(args.port, args.worker_index, workers.parse_channel_fds(args.worker_channels),
+                                  hole_punch_server)
+        elif handoff is not None:
+            udp_socket, snapshot = handoff
+            listener = engine.listen(args.port, hole_punch_server, udp_socket)
+            hotrestart.restore_snapshot(hole_punch_server, snapshot)
+        else:
+            listener = engine.listen(args.port, hole_punch_server)
+        if args.hot_restart:
+            hotrestart.HotRestartHandoff(args.port, hole_punch_server, listener, engine.stop)
+        logger.get_logger("Main").info('Listening on *:%d (%s engine)' % (args.port, args.engine))
+        for index, probe_port in enumerate(args.probe_ports):
+            listen_probe(engine, probe_port, index, hole_punch_server)
+        if args.metrics_port is not None:
+            metrics_port = args.metrics_port + (args.worker_index or 0)
+            serve_metrics(engine, metrics_port, hole_punch_server)
+        engine.run()
@@ -0,0 +1,110 @@
+"""
+Metrics collected by the server and exposed in Prometheus text format
+Updating a metric is just a dict or list increment so it can be done on every packet,
+everything else (gauges, formatting) is computed only when the endpoint is scraped
+"""
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+from errors import ERROR_CODES
+
+PREFIX = "rabid_hole_punch"
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+
+class Histogram:
+
+    def __init__(self, bounds: Tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        # Last position is the +Inf bucket
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class Metrics:
+
+    def __init__(self):
+        self.messages: Dict[str, int] = {}
+        self.invalid_requests: int = 0
+        self.errors: Dict[str, int] = {code: 0 for code in ERROR_CODES}
+        self.handler_latency: Dict[str, Histogram] = {}
+        self.cleanup_duration: Dict[str, Histogram] = {"players": Histogram(), "sessions": Histogram()}
+        self.packets_in: int = 0
+        self.packets_out: int = 0
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self.gauges: List[Tuple[str, str, Callable[[], float]]] = []
+        self.counter_sources: List[Tuple[str, str, Callable[[], Dict[str, float]], str]] = []
+
+    def observe_handler(self, message_type: str, seconds: float):
+        self.messages[message_type] = self.messages.get(message_type, 0) + 1
+        if message_type not in self.handler_latency:
+            self.handler_latency[message_type] = Histogram()
+        self.handler_latency[message_type].observe(seconds)
+
+    def count_error(self, error_code: str):
+        self.errors[error_code] = self.errors.get(error_code, 0) + 1
+
+    def add_gauge(self, name: str, description: str, value: Callable[[], float]):
+        self.gauges.append((name, description, value))
+
+    def add_counters(self, name: str, description: str, values: Callable[[], Dict[str, float]], label: str):
+        # Counters owned by other components, read when the endpoint is scraped
+        self.counter_sources.append((name, description, values, label))
+
+    def render(self) -> str:
+        lines = []
+        self.render_counter(lines, "messages_total", "Requests handled by message type",
+                            self.messages, "type")
+        self.render_counter(lines, "invalid_requests_total", "Requests rejected as invalid",
+                            {"": self.invalid_requests}, None)
+        self.render_counter(lines, "errors_total", "Error replies sent by error code", self.errors, "code")
+        self.render_counter(lines, "packets_received_total", "Datagrams received", {"": self.packets_in}, None)
+        self.render_counter(lines, "packets_sent_total", "Datagrams sent", {"": self.packets_out}, None)
+        self.render_counter(lines, "bytes_received_total", "Bytes received", {"": self.bytes_in}, None)
+        self.render_counter(lines, "bytes_sent_total", "Bytes sent", {"": self.bytes_out}, None)
+        for name, description, values, label in self.counter_sources:
+            self.render_counter(lines, name, description, values(), label)
+        for name, description, value in self.gauges:
+            lines.append(f"# HELP {PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value()}")
+        self.render_histograms(lines, "handler_seconds", "Time spent in each request handler",
+                               self.handler_latency, "type")
+        self.render_histograms(lines, "cleanup_seconds", "Time spent in each cleanup pass",
+                               self.cleanup_duration, "index")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def render_counter(lines: List[str], name: str, description: str, values: Dict, label):
+        lines.append(f"# HELP {PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        for key, value in values.items():
+            labels = f'{{{label}="{key}"}}' if label else ""
+            lines.append(f"{PREFIX}_{name}{labels} {value}")
+
+    @staticmethod
+    def render_histograms(lines: List[str], name: str, description: str, histograms: Dict, label: str):
+        lines.append(f"# HELP {PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {PREFIX}_{name} histogram")
+        for key, histogram in histograms.items():
+            lines.extend(histogram.render(f"{PREFIX}_{name}", f'{label}="{key}"'))
@@ -2,27 +2,59 @@
 Data classes to facilitate operations by the server
 """
 
+import random
+import sys
 import time
-from typing import List, Dict, Tuple
+from typing import Dict, List, Optional, Tuple
+
+import protocol
 
 PLAYER_TIMEOUT_MSECS = 5 * 1000
 SESSION_TIMEOUT_MSECS = 15 * 60 * 1000
+MEMBERSHIP_VERSION_MASK = 0xFFFFFFFF
 
 
 def current_time_millis():
-    return int(time.time() * 1000)
+    # Monotonic so timeouts do not jump with the wall clock. It is shared by every process
+    # on the machine, so timestamps still make sense after a hot restart
+    return int(time.monotonic() * 1000)
 
 
 class Player:
-
-    def __init__(self, name: str, ip: str, port: int):
-        self.name = name
-        self.ip = ip
-        self.port = port
+    # Slots keep every player at a fixed small size, there can be millions of them
+    __slots__ = ("name", "address", "binary", "last_seen", "token", "session", "versioned", "probed_ports")
+
+    def __init__(self, name: str, ip: str, port: int, binary: bool = False):
+        # Names are interned, the same few names show up in many sessions
+        self.name = sys.intern(name)
+        # The same tuple is the key of the server address index
+        self.address: Tuple[str, int] = (ip, port)
+        # Whether this player talks the binary protocol, messages sent to it are encoded accordingly
+        self.binary = binary
         self.last_seen = current_time_millis()
-
-    def is_timed_out(self):
-        return current_time_millis() - self.last_seen > PLAYER_TIMEOUT_MSECS
+        # Set by the server and the session the player joins, short form requests are handled
+        # straight from them without looking the session and player up by name
+        self.token: int = None
+        self.session: Optional["Session"] = None
+        # Whether the player sends versioned pings, it then gets membership updates instead of info messages
+        self.versioned = False
+        # (probe port index, port seen) of every probe port the player pinged, in arrival order
+        self.probed_ports: Optional[List[Tuple[int, int]]] = None
+
+    @property
+    def ip(self) -> str:
+        return self.address[0]
+
+    @property
+    def port(self) -> int:
+        return self.address[1]
+
+    def seen_within(self, fraction: float) -> bool:
+        # Whether the player was seen within that fraction of the timeout
+        return current_time_millis() - self.last_seen < PLAYER_TIMEOUT_MSECS * fraction
+
+    def expires_at(self) -> int:
+        return self.last_seen + PLAYER_TIMEOUT_MSECS
 
     def update_last_seen(self):
         self.last_seen = current_time_millis()
@@ -40,33 +72,93 @@ class Player:
 
 
 class Session:
+    __slots__ = ("name", "max_players", "host", "players", "password", "started_at", "version",
+                 "text_info_payload", "binary_info_payload", "update_payloads")
 
     def __init__(self, name: str, max_players: int, host: Player, password: str = None):
-        self.name: str = name
+        self.name: str = sys.intern(name)
         self.max_players: int = max_players
         self.host: Player = host
-        self.players: Dict = {host.name: host}
-        self.players_array: List = [host]
+        # Players by name in joining order, the host is always the first one
+        self.players: Dict[str, Player] = {host.name: host}
+        host.session = self
         self.password: str = password
         self.started_at: int = current_time_millis()
-
-    def is_timed_out(self) -> bool:
-        return current_time_millis() - self.started_at > SESSION_TIMEOUT_MSECS
+        # Changes every time a player joins or leaves. It starts at a random number so a client
+        # cannot mistake a session created again with the same name (or restored on a hot restart) for the old one
+        self.version: int = random.getrandbits(32)
+        # Encoded messages are cached here and only rebuilt when players join or leave.
+        # They are created on first use so idle sessions do not pay for empty containers
+        self.text_info_payload: Optional[bytes] = None
+        self.binary_info_payload: Optional[bytes] = None
+        self.update_payloads: Optional[Dict] = None
+
+    def expires_at(self) -> int:
+        return self.started_at + SESSION_TIMEOUT_MSECS
 
     def is_full(self) -> bool:
-        return len(self.players_array) == self.max_players
+        return len(self.players) == self.max_players
 
     def add_player(self, player: Player):
-        if len(self.players_array) < self.max_players and player.name not in self.players:
-            self.players_array.append(player)
+        if len(self.players) < self.max_players and player.name not in self.players:
             self.players[player.name] = player
+            player.session = self
+            self.membership_changed()
 
     def get_session_players_names(self) -> str:
-        return ":".join([player.name for player in self.players_array])
-
-    def get_session_players_addresses_except(self, current_player: Player) -> str:
-        return ";".join([f"{player.name}:{player.ip}:{player.port}" for player in self.players_array
-                         if player.name != current_player.name])
+        return ":".join(self.players)
+
+    def get_start_peers(self, current_player: Player, relay_ids: Dict[str, int] = None,
+                        predicted_ports: Dict[str, Tuple[int, int]] = None) -> List[Tuple]:
+        # (name, ip, port, port window, relay id) of every other player, the last two are None if not used
+        peers = []
+        for player in self.players.values():
+            if player.name == current_player.name:
+                continue
+            port, window = predicted_ports[player.name] if predicted_ports is not None else (player.port, None)
+            relay_id = relay_ids[player.name] if relay_ids is not None else None
+            peers.append((player.name, player.ip, port, window, relay_id))
+        return peers
+
+    def get_session_players_addresses_except(self, current_player: Player, relay_ids: Dict[str, int] = None,
+                                             predicted_ports: Dict[str, Tuple[int, int]] = None) -> str:
+        return ";".join(":".join(str(field) for field in peer if field is not None)
+                        for peer in self.get_start_peers(current_player, relay_ids, predicted_ports))
+
+    def get_info_payload(self, binary: bool = False) -> bytes:
+        if binary:
+            if self.binary_info_payload is None:
+                self.binary_info_payload = protocol.encode_info(list(self.players))
+            return self.binary_info_payload
+        if self.text_info_payload is None:
+            self.text_info_payload = bytes(f"i:{self.get_session_players_names()}", "utf-8")
+        return self.text_info_payload
+
+    def get_update_payload(self, binary: bool = False) -> bytes:
+        if self.update_payloads is None:
+            self.update_payloads = {}
+        if binary not in self.update_payloads:
+            if binary:
+                self.update_payloads[binary] = protocol.encode_update(self.version, list(self.players))
+            else:
+                self.update_payloads[binary] = bytes(f"u:{self.version}:{self.get_session_players_names()}", "utf-8")
+        return self.update_payloads[binary]
+
+    def get_start_payload(self, player: Player, relay_ids: Dict[str, int] = None,
+                          predicted_ports: Dict[str, Tuple[int, int]] = None) -> bytes:
+        # Built once per player when the session starts, the server keeps them for the retries.
+        # In relay mode they have the relay id of every peer, by player name in relay_ids, and with
+        # probe ports the predicted port and port window of every peer, by player name in predicted_ports
+        if player.binary:
+            return protocol.encode_start(player.port, self.get_start_peers(player, relay_ids, predicted_ports))
+        peers = self.get_session_players_addresses_except(player, relay_ids, predicted_ports)
+        return bytes(f"s:{player.port}:{peers}", "utf-8")
+
+    def membership_changed(self):
+        self.version = (self.version + 1) & MEMBERSHIP_VERSION_MASK
+        self.text_info_payload = None
+        self.binary_info_payload = None
+        self.update_payloads = None
 
     def password_match(self, input_password: str) -> bool:
         if self.password is None:
@@ -76,21 +168,17 @@ class Session:
         return self.password == input_password
 
     def is_host(self, address: Tuple) -> bool:
-        ip, port = address
-        return self.host.ip == ip and self.host.port == port
+        return self.host.address == address
 
     def remove_player(self, player_name: str):
         del self.players[player_name]
-        self.players_array = [player for player in self.players_array if player.name != player_name]
-        if self.players_array:
-            self.host = self.players_array[0]
-        else:
-            self.host = None
+        self.host = next(iter(self.players.values()), None)
+        self.membership_changed()
 
     def __eq__(self, other):
         if other is None:
             return False
-        return self.name == other.uuid
+        return self.name == other.name
 
     def __ne__(self, other):
         return not self.__eq__(other)
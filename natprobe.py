@@ -0,0 +1,80 @@
+"""
+NAT port prediction from probes to extra ports
+Optionally the server listens on a few extra UDP ports, and clients send their pings to
+each of them too. A NAT that keeps the same external port for every destination (cone)
+shows the server the same port everywhere; one that allocates a new port per destination
+(symmetric) shows a different one on each probe port, often a fixed step away from the
+previous one (sequential) and otherwise unpredictable (random).
+The start message then tells every player where to send greetings to each peer: the port
+the peer's NAT will most likely use and how many ports around it to try, instead of every
+client spraying a fixed range around the one port the server saw
+"""
+
+from typing import Dict, List, Tuple
+
+from model import Player, Session
+
+# Extra UDP ports to listen on for probes, none disables probing
+PROBE_PORTS: List[int] = []
+
+UNKNOWN = "unknown"
+CONE = "cone"
+SEQUENTIAL = "sequential"
+RANDOM = "random"
+NAT_TYPES = (UNKNOWN, CONE, SEQUENTIAL, RANDOM)
+# Larger steps between mappings are taken as random
+MAX_SEQUENTIAL_DELTA = 16
+# Ports to try on each side of the given one when nothing better is known
+DEFAULT_WINDOW = 8
+# The window is one byte in the binary protocol
+MAX_WINDOW = 255
+MAX_PORT = 65535
+
+
+def record(player: Player, probe_index: int, port: int):
+    """
+    Keeps the port seen on a probe port, only the first one, later pings reuse the same mapping
+    """
+    if player.probed_ports is None:
+        player.probed_ports = []
+    elif any(index == probe_index for index, _ in player.probed_ports):
+        return
+    player.probed_ports.append((probe_index, port))
+
+
+def classify(player: Player) -> Tuple[str, int]:
+    """
+    Returns the NAT type of the player and the step between its mappings (0 unless sequential)
+    """
+    # Mappings in the order they were made: the one for the main port when the player joined, then the probes
+    ports = [player.port] + [port for _, port in player.probed_ports or ()]
+    if len(ports) < 2:
+        return UNKNOWN, 0
+    deltas = {port - previous for previous, port in zip(ports, ports[1:])}
+    if len(deltas) == 1:
+        delta = deltas.pop()
+        if delta == 0:
+            return CONE, 0
+        if abs(delta) <= MAX_SEQUENTIAL_DELTA:
+            return SEQUENTIAL, delta
+    return RANDOM, 0
+
+
+def predict(player: Player, peers: int) -> Tuple[int, int]:
+    """
+    Returns the port the NAT of the player will most likely map for a new peer and how many
+    ports on each side of it to try, given the number of peers the player is about to greet
+    """
+    nat_type, delta = classify(player)
+    if nat_type == CONE:
+        return player.port, 0
+    if nat_type == SEQUENTIAL:
+        # Every peer it greets gets the next mapping, in whatever order it greets them
+        port = min(MAX_PORT, max(1, player.probed_ports[-1][1] + delta))
+        return port, min(MAX_WINDOW, abs(delta) * (peers - 1))
+    return player.port, DEFAULT_WINDOW
+
+
+def predict_ports(session: Session) -> Dict[str, Tuple[int, int]]:
+    peers = len(session.players) - 1
+    return {name: predict(player, peers) for name, player in session.players.items()}
@@ -0,0 +1,72 @@
+"""
+Event loop lag detection for load shedding
+A call scheduled every LAG_CHECK_SECONDS measures how late the event loop runs it, which
+is how long the loop was busy with other work (mostly reading and handling datagrams)
+before it came back to its timers. Once the lag goes over MAX_LAG_SECONDS the server is
+overloaded, and it stays so until no check has lagged for OVERLOAD_HOLD_SECONDS, so that
+shedding does not switch on and off with every check.
+While overloaded, and unless load shedding is disabled, the server sheds the traffic that
+can wait (see Server.shed_request):
+pings from players that pinged recently and replies to invalid requests. Everything else,
+starts and confirmations first of all, is handled as usual
+"""
+
+from typing import Dict
+
+import logger
+
+LAG_CHECK_SECONDS: float = 0.05
+MAX_LAG_SECONDS: float = 0.1
+OVERLOAD_HOLD_SECONDS: float = 1
+# Players whose last ping is older than this fraction of the player timeout still get their pings handled
+HEALTHY_PLAYER_FRACTION: float = 0.5
+DECISIONS = ("ping_shed", "ping_kept", "invalid_reply_shed")
+
+
+class LagMonitor:
+
+    def __init__(self, server):
+        self.clock = server.clock
+        self.logger = logger.get_logger("Overload")
+        self.overloaded = False
+        # Lag of the last check and the largest one, and last time a check lagged over the threshold
+        self.lag: float = 0
+        self.max_lag: float = 0
+        self.lagging_at = None
+        self.overload_periods: int = 0
+        self.decisions: Dict[str, int] = {decision: 0 for decision in DECISIONS}
+        self.expected_at = None
+        self.check_call = None
+        self.add_metrics(server.metrics)
+        self.schedule()
+
+    def add_metrics(self, metrics):
+        metrics.add_gauge("event_loop_lag_seconds", "How late the event loop ran the last lag check",
+                          lambda: self.lag)
+        metrics.add_gauge("event_loop_max_lag_seconds", "Largest event loop lag since the server started",
+                          lambda: self.max_lag)
+        metrics.add_gauge("overloaded", "Whether the event loop lags over the threshold",
+                          lambda: int(self.overloaded))
+        metrics.add_counters("overload_periods_total", "Times the event loop started lagging over the threshold",
+                             lambda: {"": self.overload_periods}, None)
+        metrics.add_counters("overload_decisions_total", "Low priority requests shed or kept while overloaded",
+                             lambda: self.decisions, "decision")
+
+    def schedule(self):
+        self.expected_at = self.clock.seconds() + LAG_CHECK_SECONDS
+        self.check_call = self.clock.callLater(LAG_CHECK_SECONDS, self.check)
+
+    def check(self):
+        now = self.clock.seconds()
+        self.lag = max(0, now - self.expected_at)
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.lag > MAX_LAG_SECONDS:
+            self.lagging_at = now
+            if not self.overloaded:
+                self.overloaded = True
+                self.overload_periods += 1
+                self.logger.warning("Event loop lagging %.0f ms, overloaded", self.lag * 1000)
+        elif self.overloaded and now - self.lagging_at >= OVERLOAD_HOLD_SECONDS:
+            self.overloaded = False
+            self.logger.info("Event loop caught up")
+        self.schedule()
@@ -0,0 +1,300 @@
+"""
+Binary wire protocol
+Requests are one or two bytes bigger than in text, replies with addresses and numbers smaller (see the README)
+Binary datagrams start with a magic byte that can never start a valid UTF-8 text command,
+so old text clients and binary clients can talk to the same port
+
+Every binary datagram has this header:
+    magic (1 byte, 0xFE) | version (1 byte) | opcode (1 byte, same letter as the text command)
+Strings are sent as a 1 byte length followed by the ASCII bytes, numbers are big endian,
+addresses are IPv4 only, the only family the server listens on
+
+Requests
+    h: session, player, max players (1 byte), [password]
+    c: session, player, [password]
+    p, k, x, s, y, t: session, player
+    p, y (short form): a zero byte (an empty session name) followed by the player token (4 bytes)
+    v: session, player, membership version (4 bytes)
+    v (short form): a zero byte, the player token (4 bytes), membership version (4 bytes)
+    l: order (1 byte, ASCII letter), page (2 bytes), flags (1 byte, bit 0: only sessions without password)
+Responses
+    i: player count (1 byte), player names
+    t: player token (4 bytes)
+    a: membership version (4 bytes)
+    u: membership version (4 bytes), player count (1 byte), player names
+    r: IPv4 (4 bytes) and port (2 bytes) of the node to send the request to
+    l: page (2 bytes), page count (2 bytes), session count (1 byte),
+       then for each session: name, players (1 byte), max players (1 byte), has password (1 byte)
+    s: own port (2 bytes), peer count (1 byte), then for each peer: name, IPv4 (4 bytes), port (2 bytes),
+       with probe ports its port window (1 byte) and, in relay mode, its relay id (4 bytes)
+    e: error code (1 byte, index in errors.ERROR_CODES)
+
+Relay datagrams (relay mode only) have a header of their own, with a magic byte that is not
+a text command or the binary magic either:
+    magic (1 byte, 0xFD) | relay id (4 bytes) | payload
+Players send them with the relay id of the peer, the server forwards them to that peer with
+the relay id of the sender instead, leaving the payload untouched
+"""
+
+import socket
+import struct
+from typing import List, Optional, Tuple
+
+from errors import ERROR_CODES
+
+MAGIC: int = 0xFE
+VERSION: int = 1
+RELAY_MAGIC: int = 0xFD
+
+SESSION_NAME_MAX_LENGTH = 10
+PLAYER_NAME_MAX_LENGTH = 12
+SESSION_PASS_MAX_LENGTH = 12
+MIN_PLAYERS = 2
+MAX_PLAYERS = 12
+
+HEADER = struct.Struct("!BBB")
+# Where the fields of a request start, the first one is the session name length
+FIELDS_AT = HEADER.size
+PORT = struct.Struct("!H")
+PEER_ADDRESS = struct.Struct("!4sH")
+TOKEN = struct.Struct("!I")
+MEMBERSHIP_VERSION = struct.Struct("!I")
+TOKEN_MESSAGE_TYPES = ("p", "y", "v")
+LIST_REQUEST = struct.Struct("!BHB")
+LIST_PAGE = struct.Struct("!HHB")
+LIST_ENTRY = struct.Struct("!BBB")
+LIST_OPEN_ONLY = 0x01
+RELAY_HEADER = struct.Struct("!BI")
+RELAY_ID = struct.Struct("!I")
+
+ERROR_INDEXES = {code: index for index, code in enumerate(ERROR_CODES)}
+
+
+
+def is_binary(datagram: bytes) -> bool:
+    return len(datagram) > 0 and datagram[0] == MAGIC
+
+
+def is_relay(datagram: bytes) -> bool:
+    return len(datagram) > 0 and datagram[0] == RELAY_MAGIC
+
+
+def peek_relay_id(datagram: bytes) -> Optional[int]:
+    """
+    Returns the relay id of a relay datagram, None if it is not one
+    """
+    if is_relay(datagram) and len(datagram) >= RELAY_HEADER.size:
+        return RELAY_HEADER.unpack_from(datagram)[1]
+    return None
+
+
+def peek_message_type(datagram: bytes) -> str:
+    """
+    Returns the message type of a text or binary datagram without validating it,
+    garbage datagrams just return whatever character is in the message type position
+    """
+    if is_binary(datagram):
+        return chr(datagram[2]) if len(datagram) > 2 else ""
+    return chr(datagram[0]) if datagram else ""
+
+
+def peek_session_name(datagram: bytes) -> Optional[bytes]:
+    """
+    Returns the raw session name of a text or binary datagram without validating it,
+    it is the same bytes for both protocols. None if there is no session name
+    (list requests have none, they are about every session)
+    """
+    message_type = peek_message_type(datagram)
+    if message_type == "l" or peek_token(datagram) is not None:
+        return None
+    if is_binary(datagram):
+        if len(datagram) <= HEADER.size:
+            return None
+        start = HEADER.size + 1
+        return datagram[start:start + datagram[HEADER.size]] or None
+    split = datagram.split(b":", 2)
+    if len(split) < 2:
+        return None
+    return split[1] or None
+
+
+def peek_token(datagram: bytes) -> Optional[int]:
+    """
+    Returns the player token of a short form ping or confirmation, text or binary,
+    without validating the rest of the datagram. None if it is not a short form request
+    """
+    message_type = peek_message_type(datagram)
+    if message_type not in TOKEN_MESSAGE_TYPES:
+        return None
+    if is_binary(datagram):
+        if len(datagram) >= HEADER.size + 1 + TOKEN.size and datagram[HEADER.size] == 0:
+            return TOKEN.unpack_from(datagram, HEADER.size + 1)[0]
+        return None
+    # Versioned pings have the version after the token
+    fields = datagram[2:].split(b":")
+    if datagram[1:2] != b":" or len(fields) != (2 if message_type == "v" else 1):
+        return None
+    token = fields[0]
+    if 0 < len(token) <= 10 and token.isdigit():
+        return int(token)
+    return None
+
+
+def parse(datagram: bytes) -> Tuple:
+    """
+    Parses a binary request and returns the message type and the request fields in
+    the same shape the text parsers return them. Raises ValueError if it is malformed
+    """
+    if len(datagram) < HEADER.size + 2 or datagram[1] != VERSION:
+        raise ValueError("Binary datagram too short or of an unsupported version")
+    parser = REQUEST_PARSERS.get(datagram[2])
+    if parser is None:
+        raise ValueError(f"Unknown opcode {datagram[2]}")
+    message_type, parse_fields = parser
+    return message_type, parse_fields(datagram)
+
+
+def read_names(datagram: bytes) -> Tuple:
+    """
+    Reads the session and player names after the header, returns them and the offset after them.
+    bytes.isalnum only accepts ASCII letters and digits
+    """
+    player_at = FIELDS_AT + 1 + datagram[FIELDS_AT]
+    if player_at >= len(datagram):
+        raise ValueError("Missing player name")
+    end = player_at + 1 + datagram[player_at]
+    session_name = datagram[FIELDS_AT + 1:player_at]
+    player_name = datagram[player_at + 1:end]
+    if not (0 < len(session_name) <= SESSION_NAME_MAX_LENGTH and 0 < len(player_name) <= PLAYER_NAME_MAX_LENGTH
+            and end <= len(datagram) and session_name.isalnum() and player_name.isalnum()):
+        raise ValueError("Invalid session or player name")
+    return session_name.decode("ascii"), player_name.decode("ascii"), end
+
+
+def read_password(datagram: bytes, offset: int) -> Optional[str]:
+    # Optional last field
+    if offset == len(datagram):
+        return None
+    password = datagram[offset + 1:]
+    if not (0 < len(password) == datagram[offset] <= SESSION_PASS_MAX_LENGTH and password.isalnum()):
+        raise ValueError("Invalid password")
+    return password.decode("ascii")
+
+
+def parse_session_player(datagram: bytes) -> Tuple:
+    session_name, player_name, end = read_names(datagram)
+    if end != len(datagram):
+        raise ValueError("Trailing bytes in binary datagram")
+    return session_name, player_name
+
+
+def parse_host(datagram: bytes) -> Tuple:
+    session_name, player_name, end = read_names(datagram)
+    if end == len(datagram) or not MIN_PLAYERS <= datagram[end] <= MAX_PLAYERS:
+        raise ValueError("Missing or invalid max players")
+    return session_name, player_name, datagram[end], read_password(datagram, end + 1)
+
+
+def parse_connect(datagram: bytes) -> Tuple:
+    session_name, player_name, end = read_names(datagram)
+    return session_name, player_name, read_password(datagram, end)
+
+
+def parse_ping(datagram: bytes) -> Tuple:
+    # Pings and confirmations have a short form with the token instead of the names
+    if datagram[FIELDS_AT] == 0:
+        return parse_token(datagram, 0)
+    session_name, player_name, end = read_names(datagram)
+    if end != len(datagram):
+        raise ValueError("Trailing bytes in binary datagram")
+    return session_name, player_name
+
+
+def parse_versioned_ping(datagram: bytes) -> Tuple:
+    if datagram[FIELDS_AT] == 0:
+        return parse_token(datagram, MEMBERSHIP_VERSION.size) \
+            + MEMBERSHIP_VERSION.unpack_from(datagram, HEADER.size + 1 + TOKEN.size)
+    session_name, player_name, end = read_names(datagram)
+    if end + MEMBERSHIP_VERSION.size != len(datagram):
+        raise ValueError("Missing membership version")
+    return (session_name, player_name) + MEMBERSHIP_VERSION.unpack_from(datagram, end)
+
+
+def parse_token(datagram: bytes, tail: int) -> Tuple:
+    # The token takes the place of the session and player, the server resolves it
+    if len(datagram) != HEADER.size + 1 + TOKEN.size + tail:
+        raise ValueError("Invalid short form length")
+    return TOKEN.unpack_from(datagram, HEADER.size + 1)
+
+
+def parse_list(datagram: bytes) -> Tuple:
+    if len(datagram) != HEADER.size + LIST_REQUEST.size:
+        raise ValueError("Invalid list request length")
+    order, page, flags = LIST_REQUEST.unpack_from(datagram, HEADER.size)
+    # Order, Page, Only sessions without password
+    return chr(order), page, bool(flags & LIST_OPEN_ONLY)
+
+
+# Opcode -> message type and parser of its fields
+REQUEST_PARSERS = {ord(message_type): (message_type, parser) for message_type, parser in (
+    ("h", parse_host), ("c", parse_connect), ("p", parse_ping), ("y", parse_ping), ("v", parse_versioned_ping),
+    ("k", parse_session_player), ("x", parse_session_player), ("s", parse_session_player), ("l", parse_list),
+    ("t", parse_session_player),
+)}
+
+
+def encode_header(opcode: str) -> bytes:
+    return HEADER.pack(MAGIC, VERSION, ord(opcode))
+
+
+def encode_name(name: str) -> bytes:
+    raw = name.encode("ascii")
+    return bytes((len(raw),)) + raw
+
+
+def encode_info(names: List[str]) -> bytes:
+    return encode_header("i") + bytes((len(names),)) + b"".join(encode_name(name) for name in names)
+
+
+def encode_start(own_port: int, peers: List[Tuple]) -> bytes:
+    # peers is a list of (name, ip, port, port window, relay id), the last two are None if not used.
+    # IPv4 only, like the server socket
+    parts = [encode_header("s"), PORT.pack(own_port), bytes((len(peers),))]
+    for name, ip, port, window, relay_id in peers:
+        parts.append(encode_name(name))
+        parts.append(PEER_ADDRESS.pack(socket.inet_aton(ip), port))
+        if window is not None:
+            parts.append(bytes((window,)))
+        if relay_id is not None:
+            parts.append(RELAY_ID.pack(relay_id))
+    return b"".join(parts)
+
+
+def encode_ack(version: int) -> bytes:
+    return encode_header("a") + MEMBERSHIP_VERSION.pack(version)
+
+
+def encode_update(version: int, names: List[str]) -> bytes:
+    return encode_header("u") + MEMBERSHIP_VERSION.pack(version) + bytes((len(names),)) \
+           + b"".join(encode_name(name) for name in names)
+
+
+def encode_redirect(address: Tuple[str, int]) -> bytes:
+    return encode_header("r") + PEER_ADDRESS.pack(socket.inet_aton(address[0]), address[1])
+
+
+def encode_token(token: int) -> bytes:
+    return encode_header("t") + TOKEN.pack(token)
+
+
+def encode_list(page: int, pages: int, entries: List[Tuple]) -> bytes:
+    # entries is a list of (name, players, max players, has password)
+    parts = [encode_header("l"), LIST_PAGE.pack(page, pages, len(entries))]
+    for name, players, max_players, locked in entries:
+        parts.append(encode_name(name))
+        parts.append(LIST_ENTRY.pack(players, max_players, locked))
+    return b"".join(parts)
+
+
+def encode_error(error_code: str) -> bytes:
+    return encode_header("e") + bytes((ERROR_INDEXES[error_code],))
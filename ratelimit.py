@@ -0,0 +1,50 @@
+"""
+Per source token bucket rate limiting
+Each source gets one bucket per message class. Buckets are kept in an LRU table
+with a fixed capacity so a flood of spoofed sources cannot grow memory without bounds;
+an evicted source simply starts again with a full bucket
+"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Tuple
+
+DEFAULT_CLASS = "default"
+
+
+class RateLimiter:
+
+    def __init__(self, rates: Dict[str, Tuple[float, float]], max_buckets: int,
+                 clock: Callable[[], float] = time.monotonic):
+        # rates maps a message class to (tokens per second, burst size)
+        # Classes not in the dict use the DEFAULT_CLASS rate
+        self.rates = rates
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.buckets: OrderedDict = OrderedDict()
+        self.dropped: Dict[str, int] = {}
+
+    def allow(self, source: Hashable, message_class: str) -> bool:
+        if message_class not in self.rates:
+            message_class = DEFAULT_CLASS
+        rate, burst = self.rates[message_class]
+        now = self.clock()
+        key = (source, message_class)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now]
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.dropped[message_class] = self.dropped.get(message_class, 0) + 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def __len__(self):
+        return len(self.buckets)
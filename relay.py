@@ -0,0 +1,162 @@
+"""
+Relay for players that cannot reach each other
+In relay mode every player of a session that starts gets a relay id, sent to the other
+players in the start message next to its address. Players that cannot punch a hole to a
+peer send their traffic to the server prefixed with the relay id of that peer, and the
+server forwards the payload to the peer prefixed with the relay id of the sender.
+The payload is never decoded: forwarding is two dict lookups, a token bucket and a send of
+the new header plus a memoryview of the payload. When the server reads its own socket
+(batched ingress) both parts go out in one sendmsg call without copying the payload at all.
+Only players of the same session can relay to each other, every session has its own
+bandwidth cap, and relays are dropped once nobody used them for a while
+"""
+
+from typing import Dict, Tuple
+
+import protocol
+from expiry import ExpiryIndex
+from model import Session
+
+RELAY_IDLE_SECONDS: float = 30
+# Cap of every session, what all its players relay together
+RELAY_BYTES_PER_SECOND: float = 256 * 1024
+RELAY_BURST_BYTES: float = 64 * 1024
+RELAY_ID_BITS = 31
+DROP_REASONS = ("invalid", "unknown_id", "not_member", "bandwidth", "send_error")
+
+
+class RelayGroup:
+    # Relay state of one started session
+    __slots__ = ("key", "headers", "relay_ids", "allowance", "updated_at")
+
+    def __init__(self, key: int, now: float):
+        self.key = key
+        # Address of every player -> header of the datagrams it sends to its peers
+        self.headers: Dict[Tuple, bytes] = {}
+        self.relay_ids = []
+        self.allowance: float = RELAY_BURST_BYTES
+        # Last time the allowance was refilled, which is also the last time the relay was used
+        self.updated_at = now
+
+    def take(self, size: int, now: float) -> bool:
+        self.allowance = min(RELAY_BURST_BYTES, self.allowance + (now - self.updated_at) * RELAY_BYTES_PER_SECOND)
+        self.updated_at = now
+        if self.allowance < size:
+            return False
+        self.allowance -= size
+        return True
+
+
+class Relay:
+
+    def __init__(self, server):
+        self.server = server
+        self.clock = server.clock
+        # Relay id -> (address of its player, group)
+        self.destinations: Dict[int, Tuple[Tuple, RelayGroup]] = {}
+        self.groups: Dict[int, RelayGroup] = {}
+        # Relay ids by player name of every starting session, to build its start messages
+        self.session_ids: Dict[str, Dict[str, int]] = {}
+        self.group_counter = 0
+        self.expiry = ExpiryIndex(self.group_deadline)
+        self.cleanup_call = None
+        # Transport the write method was picked for
+        self.transport = None
+        self.write = None
+        self.packets: int = 0
+        self.bytes: int = 0
+        self.dropped: Dict[str, int] = {reason: 0 for reason in DROP_REASONS}
+        self.add_metrics(server.metrics)
+
+    def add_metrics(self, metrics):
+        metrics.add_counters("relayed_packets_total", "Datagrams forwarded by the relay",
+                             lambda: {"": self.packets}, None)
+        metrics.add_counters("relayed_bytes_total", "Bytes forwarded by the relay", lambda: {"": self.bytes}, None)
+        metrics.add_counters("relay_dropped_total", "Relay datagrams dropped by reason", lambda: self.dropped, "reason")
+        metrics.add_gauge("relay_sessions", "Sessions with a relay", lambda: len(self.groups))
+
+    def open(self, session: Session) -> Dict[str, int]:
+        """
+        Gives every player of a starting session a relay id and returns them by player name
+        """
+        now = self.clock.seconds()
+        self.group_counter += 1
+        group = RelayGroup(self.group_counter, now)
+        relay_ids = {}
+        for player in session.players.values():
+            relay_id = self.new_relay_id()
+            relay_ids[player.name] = relay_id
+            group.relay_ids.append(relay_id)
+            group.headers[player.address] = protocol.RELAY_HEADER.pack(protocol.RELAY_MAGIC, relay_id)
+            self.destinations[relay_id] = (player.address, group)
+        self.groups[group.key] = group
+        self.session_ids[session.name] = relay_ids
+        if self.expiry.add(group.key, now + RELAY_IDLE_SECONDS):
+            self.schedule_cleanup()
+        return relay_ids
+
+    def session_closed(self, session_name: str):
+        # The start messages are not sent anymore, the relay itself lives on until it is idle
+        self.session_ids.pop(session_name, None)
+
+    def new_relay_id(self) -> int:
+        while True:
+            relay_id = self.server.new_routed_id(RELAY_ID_BITS)
+            if relay_id not in self.destinations:
+                return relay_id
+
+    def forward(self, datagram: bytes, address: Tuple):
+        if len(datagram) < protocol.RELAY_HEADER.size:
+            self.dropped["invalid"] += 1
+            return
+        destination = self.destinations.get(protocol.RELAY_ID.unpack_from(datagram, 1)[0])
+        if destination is None:
+            self.dropped["unknown_id"] += 1
+            return
+        peer_address, group = destination
+        header = group.headers.get(address)
+        if header is None:
+            self.dropped["not_member"] += 1
+            return
+        size = len(datagram)
+        if not group.take(size, self.clock.seconds()):
+            self.dropped["bandwidth"] += 1
+            return
+        if self.server.transport is not self.transport:
+            self.transport = self.server.transport
+            # Batched ingress can send both parts without joining them
+            self.write = self.write_vectored if hasattr(self.transport, "write_vectored") else self.write_joined
+        try:
+            self.write(header, memoryview(datagram)[protocol.RELAY_HEADER.size:], peer_address)
+        except Exception:
+            self.dropped["send_error"] += 1
+            return
+        self.packets += 1
+        self.bytes += size
+
+    def write_vectored(self, header: bytes, payload: memoryview, address: Tuple):
+        self.transport.write_vectored((header, payload), address)
+
+    def write_joined(self, header: bytes, payload: memoryview, address: Tuple):
+        self.transport.write(header + payload, address)
+
+    """
+    Cleanup of idle relays
+    """
+    def group_deadline(self, key: int):
+        group = self.groups.get(key)
+        return group.updated_at + RELAY_IDLE_SECONDS if group is not None else None
+
+    def schedule_cleanup(self):
+        if self.cleanup_call is not None and self.cleanup_call.active():
+            self.cleanup_call.cancel()
+        deadline = self.expiry.next_deadline()
+        if deadline is not None:
+            self.cleanup_call = self.clock.callLater(max(0, deadline - self.clock.seconds()), self.cleanup)
+
+    def cleanup(self):
+        for key in self.expiry.pop_expired(self.clock.seconds()):
+            group = self.groups.pop(key)
+            for relay_id in group.relay_ids:
+                del self.destinations[relay_id]
+        self.schedule_cleanup()
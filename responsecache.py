@@ -0,0 +1,69 @@
+"""
+Cache of the replies to retransmitted requests
+Clients resend create, connect, start and confirm requests until they get an answer, so the
+same datagram from the same address often arrives several times in a row. The replies sent to
+the source the first time are kept for a short while in an LRU table keyed on the address and
+the exact datagram bytes, and duplicates get them again without being parsed or validated.
+Every entry is tagged with the session it is about, the server invalidates the tag whenever
+that session changes, so a cached reply is always the one the request would get now.
+Requests answered with an error are not cached, their replies have to go through the
+error reply rate limit and load shedding every time
+"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set, Tuple
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # (address, datagram) -> [expires at, replies, session name]
+        self.entries: OrderedDict = OrderedDict()
+        self.keys_by_session: Dict[str, Set[Tuple]] = {}
+        self.hits: int = 0
+
+    def get(self, address: Tuple, datagram: bytes) -> Optional[Tuple[bytes, ...]]:
+        key = (address, datagram)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < self.clock():
+            self.delete(key)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, address: Tuple, datagram: bytes, replies: Tuple[bytes, ...], session_name: str):
+        key = (address, datagram)
+        if key in self.entries:
+            self.delete(key)
+        now = self.clock()
+        # Entries that were never asked for again are at the front, drop the expired ones
+        while self.entries:
+            oldest = next(iter(self.entries))
+            if self.entries[oldest][0] >= now:
+                break
+            self.delete(oldest)
+        self.entries[key] = [now + self.ttl, replies, session_name]
+        self.keys_by_session.setdefault(session_name, set()).add(key)
+        if len(self.entries) > self.max_entries:
+            self.delete(next(iter(self.entries)))
+
+    def invalidate(self, session_name: str):
+        for key in self.keys_by_session.pop(session_name, ()):
+            del self.entries[key]
+
+    def delete(self, key: Tuple):
+        _, _, session_name = self.entries.pop(key)
+        keys = self.keys_by_session[session_name]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_session[session_name]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,108 @@
+"""
+Central retransmission queue
+Messages that have to be sent more than once (timeout errors, start session messages...)
+are queued here instead of having their own coroutine. A single timer armed for the
+earliest pending send flushes every packet that is due in the same batch
+"""
+
+import heapq
+from typing import Callable, Dict, Hashable, List, Tuple
+
+# Packets due within this window are flushed in the same tick to batch writes
+FLUSH_WINDOW_SECONDS: float = 0.005
+
+
+class RetryPolicy:
+
+    def __init__(self, tries: int, interval: float, backoff: float = 1.0):
+        self.tries = tries
+        self.interval = interval
+        self.backoff = backoff
+
+
+class Retransmit:
+
+    def __init__(self, address: Tuple, payload: bytes, policy: RetryPolicy, tag: Hashable = None):
+        self.address = address
+        self.payload = payload
+        self.tag = tag
+        self.remaining = policy.tries - 1
+        self.interval = policy.interval
+        self.backoff = policy.backoff
+        self.cancelled = False
+
+
+class RetransmitQueue:
+
+    def __init__(self, clock, write: Callable[[Tuple, bytes], None]):
+        # clock must provide callLater(delay, f) and seconds(), like the twisted reactor
+        self.clock = clock
+        self.write = write
+        self.heap: List = []
+        self.tagged: Dict[Hashable, List[Retransmit]] = {}
+        self.counter: int = 0
+        self.call = None
+        self.due_at = None
+
+    def send(self, address: Tuple, payload: bytes, policy: RetryPolicy, tag: Hashable = None):
+        """
+        Writes the payload right away and queues the remaining tries.
+        A tag can be given to cancel the pending tries later
+        """
+        self.write(address, payload)
+        entry = Retransmit(address, payload, policy, tag)
+        if entry.remaining <= 0:
+            return
+        if tag is not None:
+            self.tagged.setdefault(tag, []).append(entry)
+        due_at = self.clock.seconds() + entry.interval
+        self.push(entry, due_at)
+        if self.due_at is None or due_at < self.due_at:
+            self.arm()
+
+    def cancel(self, tag: Hashable):
+        # Entries are only flagged, they are dropped from the heap when they become due
+        for entry in self.tagged.pop(tag, []):
+            entry.cancelled = True
+
+    def flush(self):
+        self.call = None
+        self.due_at = None
+        now = self.clock.seconds()
+        while self.heap and self.heap[0][0] <= now + FLUSH_WINDOW_SECONDS:
+            _, _, entry = heapq.heappop(self.heap)
+            if entry.cancelled:
+                continue
+            self.write(entry.address, entry.payload)
+            entry.remaining -= 1
+            if entry.remaining > 0:
+                entry.interval *= entry.backoff
+                self.push(entry, now + entry.interval)
+            elif entry.tag is not None:
+                self.forget(entry)
+        self.arm()
+
+    def push(self, entry: Retransmit, due_at: float):
+        self.counter += 1
+        heapq.heappush(self.heap, (due_at, self.counter, entry))
+
+    def arm(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        self.due_at = None
+        if not self.heap:
+            return
+        self.due_at = self.heap[0][0]
+        self.call = self.clock.callLater(max(0.0, self.due_at - self.clock.seconds()), self.flush)
+
+    def forget(self, entry: Retransmit):
+        entries = self.tagged.get(entry.tag)
+        if entries is None:
+            return
+        entries.remove(entry)
+        if not entries:
+            del self.tagged[entry.tag]
+
+    def __len__(self):
+        return len(self.heap)
@@ -1,63 +1,292 @@
 """
 This class is the one handling the requests and rerouting them
 to the correspondent handler function
+It does not depend on any event loop: the engine running it (see twisted_engine and
+asyncio_engine) gives it a clock and a transport and calls datagramReceived
 """
-from typing import Tuple
-
-from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
-from twisted.internet.protocol import DatagramProtocol
-from twisted.internet.task import deferLater
+import secrets
+import time
+from typing import Optional, Tuple
 
+import capture
 import logger
+import natprobe
+import overload
+import protocol
 import re
 from errors import *
-from model import Session, Player, InvalidRequest, IgnoredRequest
+from expiry import ExpiryIndex
+from lobbies import LobbyIndex, LIST_MAX_PAGES, ORDERS
+from metrics import Metrics
+from model import Session, Player, InvalidRequest, IgnoredRequest, current_time_millis
+from overload import LagMonitor
+from ratelimit import RateLimiter, DEFAULT_CLASS
+from relay import Relay
+from responsecache import ResponseCache
+from retransmit import RetransmitQueue, RetryPolicy
 
 UDP_MESSAGE_SECONDS_BETWEEN_TRIES: float = 0.05
-SESSION_CLEANUP_SCHEDULED_SECONDS: float = 60 * 5
-PLAYER_CLEANUP_SCHEDULED_SECONDS: float = 8
 CONFIRMATION_RETRIES: int = 8
 SECONDS_BETWEEN_CONFIRMATION_RETRIES: float = 0.1
+START_RETRY_POLICY = RetryPolicy(CONFIRMATION_RETRIES, SECONDS_BETWEEN_CONFIRMATION_RETRIES)
+
+# Rate limits are (tokens per second, burst) per source and message type
+# Sources are (ip, port) addresses by default, so players behind the same carrier grade NAT
+# do not share a budget
+RATE_LIMIT_ENABLED: bool = True
+# Lets players of started sessions send traffic to each other through the server, see relay.py
+RELAY_ENABLED: bool = False
+# Keys the buckets by IP instead, so changing the source port does not give a new budget.
+# A whole IP gets RATE_LIMIT_PER_IP_FACTOR times the budget of an address
+RATE_LIMIT_BY_IP: bool = False
+RATE_LIMIT_PER_IP_FACTOR: int = 10
+RATE_LIMIT_MAX_BUCKETS: int = 100000
+ERROR_REPLY_CLASS = "error"
+# List replies are much bigger than the request, so they get the smallest budget
+RATE_LIMITS = {"p": (20, 40), "v": (20, 40), "l": (2, 5), DEFAULT_CLASS: (10, 20), ERROR_REPLY_CLASS: (5, 10)}
+
+# Sheds pings from healthy players and replies to invalid requests while the event loop lags, see overload.py
+LOAD_SHEDDING_ENABLED: bool = True
+SHED_MESSAGE_TYPES = ("p", "v")
+
+# Replies to these requests are sent again as they are to exact duplicates arriving within the window
+CACHED_MESSAGE_TYPES = ("h", "c", "s", "y")
+RESPONSE_CACHE_SECONDS: float = 1
+RESPONSE_CACHE_MAX_ENTRIES: int = 10000
 
 SESSION_NAME_REGEX = "[A-Za-z0-9]{1,10}"
 PLAYER_NAME_REGEX = "[A-Za-z0-9]{1,12}"
 MAX_PLAYERS_REGEX = "([2-9]|1[0-2])"
 SESSION_PASS_REGEX = "[A-Za-z0-9]{1,12}"
+LIST_ORDER_REGEX = "[fa]"
+LIST_PAGE_REGEX = "[0-9]{1,5}"
+TOKEN_REGEX = "^[0-9]{1,10}$"
+MEMBERSHIP_VERSION_REGEX = "[0-9]{1,10}"
+TOKEN_BITS = 31
 
 SESSION_PLAYER_REGEX = "^" + SESSION_NAME_REGEX + ":" + PLAYER_NAME_REGEX + "$"
 SESSION_PLAYER_PASS_REGEX = "^" + SESSION_NAME_REGEX + ":" + PLAYER_NAME_REGEX + "(:" + SESSION_PASS_REGEX + ")?$"
 SESSION_HOST_REGEX = "^" + SESSION_NAME_REGEX + ":" + PLAYER_NAME_REGEX + ":" + MAX_PLAYERS_REGEX \
                      + "(:" + SESSION_PASS_REGEX + ")?$"
-
-
-class Server(DatagramProtocol):
-
-    def __init__(self):
+SESSION_PLAYER_VERSION_REGEX = "^" + SESSION_NAME_REGEX + ":" + PLAYER_NAME_REGEX + ":" + MEMBERSHIP_VERSION_REGEX + "$"
+TOKEN_VERSION_REGEX = "^[0-9]{1,10}:" + MEMBERSHIP_VERSION_REGEX + "$"
+LIST_REGEX = "^" + LIST_ORDER_REGEX + ":" + LIST_PAGE_REGEX + "(:o)?$"
+
+SESSION_PLAYER_PATTERN = re.compile(SESSION_PLAYER_REGEX)
+SESSION_PLAYER_PASS_PATTERN = re.compile(SESSION_PLAYER_PASS_REGEX)
+SESSION_HOST_PATTERN = re.compile(SESSION_HOST_REGEX)
+LIST_PATTERN = re.compile(LIST_REGEX)
+TOKEN_PATTERN = re.compile(TOKEN_REGEX)
+SESSION_PLAYER_VERSION_PATTERN = re.compile(SESSION_PLAYER_VERSION_REGEX)
+TOKEN_VERSION_PATTERN = re.compile(TOKEN_VERSION_REGEX)
+
+
+def rate_limits() -> dict:
+    if not RATE_LIMIT_BY_IP:
+        return RATE_LIMITS
+    return {message_class: (rate * RATE_LIMIT_PER_IP_FACTOR, burst * RATE_LIMIT_PER_IP_FACTOR)
+            for message_class, (rate, burst) in RATE_LIMITS.items()}
+
+
+class Server:
+
+    def __init__(self, clock):
+        # clock must provide callLater(delay, f, *args) returning a call with active() and cancel(),
+        # and seconds(), like the twisted reactor
+        self.clock = clock
+        # Set by the engine, it must provide write(payload, address)
+        self.transport = None
         self.active_sessions = {}
         self.starting_sessions = {}
+        # Clock time at which each starting session stops sending the start message
+        self.starting_closes_at = {}
+        # Start message of every player of a starting session by (session, player), as built when it
+        # started. Players that confirm leave the session, so it can not be rebuilt for the others later
+        self.start_payloads = {}
         self.logger = logger.get_logger("Server")
         self.message_handlers = {"h": self.host_session, "c": self.connect_session, "p": self.player_ping,
                                  "k": self.kick_player, "x": self.exit_session, "s": self.start_session,
-                                 "y": self.confirm_player}
-        reactor.callLater(SESSION_CLEANUP_SCHEDULED_SECONDS, self.cleanup_sessions)
-        reactor.callLater(PLAYER_CLEANUP_SCHEDULED_SECONDS, self.cleanup_players)
+                                 "y": self.confirm_player, "l": self.list_sessions,
+                                 "v": self.player_versioned_ping, "t": self.player_token}
+        self.message_parsers = {"h": self.parse_host_request, "c": self.parse_connect_request,
+                                "p": self.parse_token_or_session_player_from, "k": self.parse_session_player_from,
+                                "x": self.parse_session_player_from, "s": self.parse_session_player_from,
+                                "y": self.parse_token_or_session_player_from, "l": self.parse_list_request,
+                                "v": self.parse_versioned_ping, "t": self.parse_session_player_from}
+        # Whether the request being handled came in binary, replies to its source are encoded the same way
+        self.reply_binary = False
+        self.request_address = None
+        # Replies sent to the source of the request being handled, collected for the response cache
+        self.request_replies = None
+        self.response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_SECONDS, clock.seconds)
+        # Player of every address in a session, it resolves short form requests in one lookup.
+        # If an address is in several sessions, the last one it joined wins
+        self.players_by_address = {}
+        # Checked by hot paths so they do not even build the debug arguments when debug is off
+        self.debug = logger.is_debug_enabled()
+        self.rate_limiter = RateLimiter(rate_limits(), RATE_LIMIT_MAX_BUCKETS)
+        self.session_expiry = ExpiryIndex(self.session_deadline)
+        self.player_expiry = ExpiryIndex(self.player_deadline)
+        self.session_cleanup_call = None
+        self.player_cleanup_call = None
+        # Active sessions that are not full, kept up to date by session_changed
+        self.lobbies = LobbyIndex()
+        self.retransmits = RetransmitQueue(clock, self.send_payload)
+        # Set in multi-process mode to send datagrams of sessions owned by other workers to them
+        self.router = None
+        # Set in cluster mode to share session names with other nodes
+        self.cluster = None
+        # Set in capture mode to record the received traffic
+        self.capture = None
+        self.metrics = Metrics()
+        self.metrics.add_gauge("active_sessions", "Sessions waiting for players", lambda: len(self.active_sessions))
+        self.metrics.add_gauge("starting_sessions", "Sessions sending the start message",
+                               lambda: len(self.starting_sessions))
+        self.metrics.add_gauge("joinable_sessions", "Active sessions that are not full", lambda: len(self.lobbies))
+        self.metrics.add_gauge("players", "Players in active or starting sessions", self.count_players)
+        self.metrics.add_gauge("pending_retransmits", "Packets waiting in the retransmit queue",
+                               lambda: len(self.retransmits))
+        self.metrics.add_counters("rate_limited_total", "Datagrams dropped by the rate limiter by class",
+                                  lambda: self.rate_limiter.dropped, "class")
+        self.metrics.add_counters("cached_replies_total", "Duplicate requests answered from the response cache",
+                                  lambda: {"": self.response_cache.hits}, None)
+        self.metrics.add_gauge("response_cache_entries", "Requests in the response cache",
+                               lambda: len(self.response_cache))
+        self.relay = Relay(self) if RELAY_ENABLED else None
+        self.lag_monitor = LagMonitor(self)
+        self.probes_received = 0
+        # Players of started sessions by NAT type, only with probe ports
+        self.nat_types = {nat_type: 0 for nat_type in natprobe.NAT_TYPES}
+        if natprobe.PROBE_PORTS:
+            self.metrics.add_counters("probes_received_total", "Pings received on the probe ports",
+                                      lambda: {"": self.probes_received}, None)
+            self.metrics.add_counters("nat_types_total", "Players of started sessions by NAT type",
+                                      lambda: self.nat_types, "type")
+        self.metrics.add_counters("log_records_dropped_total", "Log records dropped because the queue was full",
+                                  lambda: {"": logger.dropped_records}, None)
 
     def datagramReceived(self, datagram, address):
-        datagram_string = datagram.decode("utf-8")
-        self.logger.debug("Received datagram %s", datagram_string)
+        if self.relay is not None and protocol.is_relay(datagram):
+            # Relayed traffic has its own counters and bandwidth caps
+            if self.router is None or not self.router.forward(datagram, address):
+                self.relay.forward(datagram, address)
+            return
+        if self.capture is not None:
+            self.capture.record(datagram, address)
+        self.metrics.packets_in += 1
+        self.metrics.bytes_in += len(datagram)
+        if RATE_LIMIT_ENABLED \
+                and not self.rate_limiter.allow(self.rate_limit_source(address), protocol.peek_message_type(datagram)):
+            return
+        if self.router is not None and self.router.forward(datagram, address):
+            return
+        self.handle_datagram(datagram, address)
+
+    def probe_received(self, probe_index: int, datagram: bytes, address: Tuple):
+        """
+        Pings sent to a probe port only tell which port the NAT of the player mapped for it,
+        they get no reply and invalid ones are dropped silently
+        """
+        self.metrics.packets_in += 1
+        self.metrics.bytes_in += len(datagram)
+        if RATE_LIMIT_ENABLED and not self.rate_limiter.allow(self.rate_limit_source(address), "p"):
+            return
+        try:
+            if protocol.is_binary(datagram):
+                message_type, request = protocol.parse(datagram)
+            else:
+                message = datagram.decode("utf-8")
+                message_type, request = message[:1], message[2:].split(":")
+                if message[1:2] != ":" or not SESSION_PLAYER_PATTERN.match(message[2:]):
+                    return
+        except ValueError:
+            return
+        if message_type != "p" or not isinstance(request[0], str):
+            return
+        session = self.active_sessions.get(request[0])
+        player = session.players.get(request[1]) if session is not None else None
+        # Only the player itself can probe, from the same IP
+        if player is None or player.ip != address[0]:
+            return
+        self.probes_received += 1
+        natprobe.record(player, probe_index, address[1])
 
+    def handle_datagram(self, datagram: bytes, address: Tuple):
+        if self.lag_monitor.overloaded and LOAD_SHEDDING_ENABLED and self.shed_request(datagram, address):
+            return
+        cacheable = protocol.peek_message_type(datagram) in CACHED_MESSAGE_TYPES
+        if cacheable:
+            replies = self.response_cache.get(address, datagram)
+            if replies is not None:
+                for payload in replies:
+                    self.send_payload(address, payload)
+                return
+            self.request_replies = []
+        # Only set once the request is parsed, unparseable requests are not cached
+        cached_session_name = None
+        self.request_address = address
         try:
-            message_type, message = self.parse_datagram_string(datagram_string, address)
-            if message_type not in self.message_handlers.keys():
-                raise InvalidRequest
-            self.message_handlers[message_type](message, address)
+            self.reply_binary = protocol.is_binary(datagram)
+            if self.reply_binary:
+                message_type, request = self.parse_binary_datagram(datagram, address)
+            else:
+                datagram_string = self.decode_datagram(datagram, address)
+                if self.debug:
+                    self.logger.debug("Received datagram %s", datagram_string)
+                message_type, message = self.parse_datagram_string(datagram_string, address)
+                if message_type not in self.message_parsers.keys():
+                    raise InvalidRequest
+                request = self.message_parsers[message_type](message, address)
+            if cacheable:
+                cached_session_name = request[0].session.name if type(request[0]) is Player else request[0]
+            started = time.perf_counter()
+            try:
+                self.message_handlers[message_type](request, address)
+            finally:
+                self.metrics.observe_handler(message_type, time.perf_counter() - started)
         except IgnoredRequest:
             pass
         except InvalidRequest as e:
-            self.logger.debug("Invalid request: %s", str(e))
+            self.metrics.invalid_requests += 1
+            if self.debug:
+                self.logger.debug("Invalid request: %s", str(e))
         except Exception as e:
+            cached_session_name = None
             self.logger.error("Uncontrolled error: %s", str(e))
+        finally:
+            if cached_session_name is not None and self.request_replies is not None:
+                self.response_cache.put(address, datagram, tuple(self.request_replies), cached_session_name)
+            self.request_replies = None
+            self.request_address = None
+
+    def shed_request(self, datagram: bytes, address: Tuple) -> bool:
+        """
+        Whether to drop a request while overloaded. Only pings from players of active sessions
+        that pinged recently are dropped, they will ping again long before they time out.
+        Pings of starting sessions get the start message again and are always handled
+        """
+        if protocol.peek_message_type(datagram) not in SHED_MESSAGE_TYPES:
+            return False
+        player = self.players_by_address.get(address)
+        if player is None or self.active_sessions.get(player.session.name) is not player.session:
+            return False
+        if player.seen_within(overload.HEALTHY_PLAYER_FRACTION):
+            self.lag_monitor.decisions["ping_shed"] += 1
+            return True
+        self.lag_monitor.decisions["ping_kept"] += 1
+        return False
+
+    @staticmethod
+    def rate_limit_source(address: Tuple):
+        return address[0] if RATE_LIMIT_BY_IP else address
+
+    def decode_datagram(self, datagram: bytes, address: Tuple) -> str:
+        try:
+            return datagram.decode("utf-8")
+        except UnicodeDecodeError as e:
+            self.logger.debug("Datagram that is not UTF-8 received: %s", str(e))
+            self.send_message(address, ERR_REQUEST_INVALID)
+            raise InvalidRequest(f"Datagram that is not UTF-8 received: {str(e)}")
 
     def parse_datagram_string(self, data_string: str, address: Tuple) -> Tuple:
         split = data_string.split(":", 1)
@@ -67,23 +296,42 @@ class Server(DatagramProtocol):
             raise InvalidRequest(f"Invalid datagram received {data_string}")
         return split[0], split[1]
 
+    def parse_binary_datagram(self, datagram: bytes, address: Tuple) -> Tuple:
+        try:
+            message_type, request = protocol.parse(datagram)
+        except ValueError as e:
+            self.logger.debug("Invalid binary datagram received: %s", str(e))
+            self.send_message(address, ERR_REQUEST_INVALID)
+            raise InvalidRequest(f"Invalid binary datagram received: {str(e)}")
+        if message_type not in self.message_handlers.keys():
+            raise InvalidRequest
+        if isinstance(request[0], int):
+            return message_type, (self.resolve_token(request[0], address),) + request[1:]
+        return message_type, request
+
     """
     Commands handling methods
     """
-    def host_session(self, message: str, address: Tuple):
-        session_name, player_name, max_players, password = self.parse_host_request(message, address)
+    def host_session(self, request: Tuple, address: Tuple):
+        session_name, player_name, max_players, password = request
         ip, port = address
         self.logger.debug("Received request from player %s to host session %s for max %s players. Source: %s:%s",
                           player_name, session_name, max_players, ip, port)
 
         self.check_host_session(session_name, address)
 
-        self.active_sessions[session_name] = Session(session_name, max_players, Player(player_name, ip, port), password)
+        host = self.create_player(player_name, address)
+        self.active_sessions[session_name] = Session(session_name, max_players, host, password)
+        if self.capture is not None:
+            self.capture.record_value(capture.KIND_SESSION_VERSION, self.active_sessions[session_name].version)
+        self.track_session(session_name)
+        self.track_player(session_name, player_name)
+        self.session_changed(self.active_sessions[session_name])
         self.logger.info("Created session %s (max %s players)", session_name, max_players)
         self.send_session_info(address, self.active_sessions[session_name])
 
-    def connect_session(self, message: str, address: Tuple):
-        session_name, player_name, session_password = self.parse_connect_request(message, address)
+    def connect_session(self, request: Tuple, address: Tuple):
+        session_name, player_name, session_password = request
         ip, port = address
         self.logger.debug("Received request from player %s to connect to session %s. Source: %s:%s",
                           player_name, session_name, ip, port)
@@ -91,32 +339,91 @@ class Server(DatagramProtocol):
         self.check_connect_session(session_name, session_password, player_name, address)
 
         session = self.active_sessions[session_name]
-        session.add_player(Player(player_name, ip, port))
+        player = self.create_player(player_name, address)
+        session.add_player(player)
+        self.track_player(session_name, player_name)
+        self.session_changed(session)
         self.logger.info("Connected player %s to session %s", player_name, session_name)
         self.broadcast_session_info(session)
 
-    def player_ping(self, message: str, address: Tuple):
-        session_name, player_name = self.parse_session_player_from(message, address)
-        ip, port = address
-        self.logger.debug("Received ping from player %s from session %s. Source: %s:%s",
-                          player_name, session_name, ip, port)
+    def player_token(self, request: Tuple, address: Tuple):
+        # Clients that want to send short form requests ask for their token once they joined
+        session_name, player_name = request
+        player = self.players_by_address.get(address)
+        if player is None or player.name != player_name or player.session.name != session_name:
+            self.logger.debug("No player %s of session %s at %s:%s", player_name, session_name, address[0], address[1])
+            self.send_message(address, ERR_SESSION_PLAYER_NON_EXISTENT)
+            raise InvalidRequest(f"No player {player_name} of session {session_name} at {address[0]}:{address[1]}")
+        self.send_token(address, player)
 
+    def player_ping(self, request: Tuple, address: Tuple):
+        # Short form pings come with the player found by its token instead of the names
+        if type(request[0]) is Player:
+            session = self.refresh_token_player(request[0], address)
+        else:
+            session_name, player_name = request
+            if self.debug:
+                ip, port = address
+                self.logger.debug("Received ping from player %s from session %s. Source: %s:%s",
+                                  player_name, session_name, ip, port)
+            session = self.refresh_player(session_name, player_name, address)
+        if session is not None:
+            self.send_session_info(address, session)
+
+    def player_versioned_ping(self, request: Tuple, address: Tuple):
+        if type(request[0]) is Player:
+            player, version = request
+            session = self.refresh_token_player(player, address)
+        else:
+            session_name, player_name, version = request
+            if self.debug:
+                ip, port = address
+                self.logger.debug("Received ping with version %s from player %s from session %s. Source: %s:%s",
+                                  version, player_name, session_name, ip, port)
+            session = self.refresh_player(session_name, player_name, address)
+            player = session.players[player_name] if session is not None else None
+        if session is None:
+            return
+        # From now on membership changes are pushed to this player as updates
+        player.versioned = True
+        if version == session.version:
+            payload = protocol.encode_ack(version) if self.reply_binary else bytes(f"a:{version}", "utf-8")
+            self.send_payload(address, payload)
+        else:
+            self.send_payload(address, session.get_update_payload(self.reply_binary))
+
+    def refresh_player(self, session_name: str, player_name: str, address: Tuple) -> Optional[Session]:
+        # Common part of both pings. Returns the active session of the player, or None if
+        # the session is starting and the start message was sent again instead
         if session_name in self.starting_sessions.keys() \
                 and player_name in self.starting_sessions[session_name].players.keys():
-            self.logger.debug("Session %s is starting, sending addresses", session_name)
             session = self.starting_sessions[session_name]
-            player = session.players[player_name]
-            self.send_message(address, f"s:{player.port}:{session.get_session_players_addresses_except(player)}")
-            return
+            self.send_start_again(session, session.players[player_name], address)
+            return None
         self.check_active_session(session_name, address)
         session = self.active_sessions[session_name]
         self.check_player_exists_in(session, player_name, address)
 
         session.players[player_name].update_last_seen()
-        self.send_session_info(address, session)
-
-    def kick_player(self, message: str, address: Tuple):
-        session_name, player_name = self.parse_session_player_from(message, address)
+        return session
+
+    def refresh_token_player(self, player: Player, address: Tuple) -> Optional[Session]:
+        # refresh_player for a player found by its token. Only players of active or starting
+        # sessions are in the address index, so the session of the player is one of them
+        session = player.session
+        if session.name in self.starting_sessions:
+            self.send_start_again(session, player, address)
+            return None
+        player.update_last_seen()
+        return session
+
+    def send_start_again(self, session: Session, player: Player, address: Tuple):
+        if self.debug:
+            self.logger.debug("Session %s is starting, sending addresses", session.name)
+        self.send_payload(address, self.start_payloads[(session.name, player.name)])
+
+    def kick_player(self, request: Tuple, address: Tuple):
+        session_name, player_name = request
         ip, port = address
         self.logger.debug("Received command to kick player %s from session %s. Source: %s:%s",
                           player_name, session_name, ip, port)
@@ -128,15 +435,17 @@ class Server(DatagramProtocol):
 
         player = session.players[player_name]
         session.remove_player(player_name)
-        self.send_message((player.ip, player.port), ERR_SESSION_PLAYER_KICKED_BY_HOST)
+        self.forget_player(player)
+        self.send_message(player.address, ERR_SESSION_PLAYER_KICKED_BY_HOST, binary=player.binary)
         self.logger.info("Kicked player %s from session %s", player_name, session_name)
-        if not session.players_array:
+        if not session.players:
             del self.active_sessions[session_name]
             self.logger.info("No more players in session %s, deleted session", session_name)
+        self.session_changed(session)
         self.broadcast_session_info(session)
 
-    def exit_session(self, message: str, address: Tuple):
-        session_name, player_name = self.parse_session_player_from(message, address)
+    def exit_session(self, request: Tuple, address: Tuple):
+        session_name, player_name = request
         ip, port = address
         self.logger.debug("Received command to exit session %s from player %s. Source: %s:%s",
                           session_name, player_name, ip, port)
@@ -145,96 +454,169 @@ class Server(DatagramProtocol):
         session = self.active_sessions[session_name]
         self.check_player_exists_in(session, player_name, address)
 
+        self.forget_player(session.players[player_name])
         session.remove_player(player_name)
         self.send_message(address, ERR_SESSION_PLAYER_EXIT)
         self.logger.info("Player %s exited session %s", player_name, session_name)
-        if not session.players_array:
+        if not session.players:
             del self.active_sessions[session_name]
             self.logger.info("No more players in session %s, deleted session", session_name)
+        self.session_changed(session)
+        self.broadcast_session_info(session)
 
-    @inlineCallbacks
-    def start_session(self, message: str, address: Tuple):
-        # TryExcept is required because @inlineCallbacks wraps this piece of code so
-        # external TryExcept won't catch exceptions thrown here
-        try:
-            session_name, source_player_name = self.parse_session_player_from(message, address)
-            ip, port = address
-            self.logger.debug("Received start session %s from player %s Source: %s:%s",
-                              session_name, source_player_name, ip, port)
-
-            if session_name in self.starting_sessions.keys():
-                self.logger.debug("Session %s already started", session_name)
-                return
-            self.check_active_session(session_name, address)
-            session = self.active_sessions[session_name]
-            self.check_player_is_host(session, address)
-            if len(session.players_array) == 1:
-                self.logger.debug("Cannot start session %s with only one player", session_name)
-                self.send_message(address, ERR_SESSION_SINGLE_PLAYER)
-                raise InvalidRequest(f"Cannot start session {session_name} with only one player")
-
-            del self.active_sessions[session_name]
-            self.starting_sessions[session_name] = session
-            for i in range(CONFIRMATION_RETRIES):
-                if session.players_array:
-                    for player_name in list(session.players.keys()):
-                        if player_name in session.players.keys():
-                            player = session.players[player_name]
-                            self.send_message((player.ip, player.port),
-                                              f"s:{player.port}:{session.get_session_players_addresses_except(player)}")
-                    yield sleep(SECONDS_BETWEEN_CONFIRMATION_RETRIES)
-            del self.starting_sessions[session_name]
-            self.logger.info("All addresses sent for session %s. Session closed.", session_name)
-        except IgnoredRequest:
-            pass
-        except InvalidRequest as e:
-            self.logger.debug("Invalid request: %s", str(e))
-        except Exception as e:
-            self.logger.error("Uncontrolled error: %s", str(e))
-
-    def confirm_player(self, message: str, address: Tuple):
-        session_name, player_name = self.parse_session_player_from(message, address)
+    def start_session(self, request: Tuple, address: Tuple):
+        session_name, source_player_name = request
         ip, port = address
-        self.logger.debug("Received confirmation about addresses reception for session %s from player %s Source: %s:%s",
-                          session_name, player_name, ip, port)
+        self.logger.debug("Received start session %s from player %s Source: %s:%s",
+                          session_name, source_player_name, ip, port)
 
-        self.check_starting_session(session_name, address)
-        session = self.starting_sessions[session_name]
-        self.check_player_exists_in(session, player_name, address)
+        if session_name in self.starting_sessions.keys():
+            self.logger.debug("Session %s already started", session_name)
+            return
+        self.check_active_session(session_name, address)
+        session = self.active_sessions[session_name]
+        self.check_player_is_host(session, address)
+        if len(session.players) == 1:
+            self.logger.debug("Cannot start session %s with only one player", session_name)
+            self.send_message(address, ERR_SESSION_SINGLE_PLAYER)
+            raise InvalidRequest(f"Cannot start session {session_name} with only one player")
+
+        del self.active_sessions[session_name]
+        self.starting_sessions[session_name] = session
+        self.session_changed(session)
+        if self.relay is not None:
+            self.relay.open(session)
+        if natprobe.PROBE_PORTS:
+            for player in session.players.values():
+                self.nat_types[natprobe.classify(player)[0]] += 1
+        for player in session.players.values():
+            payload = self.get_start_payload(session, player)
+            self.start_payloads[(session_name, player.name)] = payload
+            self.retransmits.send(player.address, payload, START_RETRY_POLICY, (session_name, player.name))
+        self.starting_closes_at[session_name] = \
+            self.clock.seconds() + CONFIRMATION_RETRIES * SECONDS_BETWEEN_CONFIRMATION_RETRIES
+        self.clock.callLater(CONFIRMATION_RETRIES * SECONDS_BETWEEN_CONFIRMATION_RETRIES,
+                             self.close_starting_session, session_name)
+
+    def close_starting_session(self, session_name: str):
+        session = self.starting_sessions.pop(session_name)
+        del self.starting_closes_at[session_name]
+        self.session_changed(session)
+        if self.relay is not None:
+            self.relay.session_closed(session_name)
+        for player in session.players.values():
+            self.forget_player(player)
+            self.retransmits.cancel((session_name, player.name))
+            self.start_payloads.pop((session_name, player.name), None)
+        self.logger.info("All addresses sent for session %s. Session closed.", session_name)
+
+    def confirm_player(self, request: Tuple, address: Tuple):
+        if type(request[0]) is Player:
+            player = request[0]
+            session_name, player_name = player.session.name, player.name
+            self.check_starting_session(session_name, address)
+            session = player.session
+        else:
+            session_name, player_name = request
+            if self.debug:
+                ip, port = address
+                self.logger.debug("Received confirmation about addresses reception for session %s from player %s "
+                                  "Source: %s:%s", session_name, player_name, ip, port)
+            self.check_starting_session(session_name, address)
+            session = self.starting_sessions[session_name]
+            self.check_player_exists_in(session, player_name, address)
+            player = session.players[player_name]
 
+        self.forget_player(player)
         session.remove_player(player_name)
+        self.session_changed(session)
+        self.retransmits.cancel((session_name, player_name))
+        self.start_payloads.pop((session_name, player_name), None)
         self.logger.info("Player %s from session %s received other players' addresses", player_name, session_name)
 
+    def list_sessions(self, request: Tuple, address: Tuple):
+        order, page, open_only = request
+        if self.debug:
+            ip, port = address
+            self.logger.debug("Received list request for page %s by %s (open only: %s). Source: %s:%s",
+                              page, order, open_only, ip, port)
+
+        if order not in ORDERS or page >= LIST_MAX_PAGES:
+            self.send_message(address, ERR_REQUEST_INVALID)
+            raise InvalidRequest(f"Invalid list request for page {page} by {order}")
+        self.send_payload(address, self.lobbies.get_page_payload(order, page, open_only, self.reply_binary))
+
     """
     Message sending helper methods
     """
     def broadcast_session_info(self, session: Session):
-        for player in session.players_array:
-            self.send_session_info((player.ip, player.port), session)
+        for player in session.players.values():
+            if player.versioned:
+                self.send_payload(player.address, session.get_update_payload(player.binary))
+            else:
+                self.send_payload(player.address, session.get_info_payload(player.binary))
 
     def send_session_info(self, address: Tuple, session: Session):
-        self.send_message(address, f"i:{session.get_session_players_names()}")
+        self.send_payload(address, session.get_info_payload(self.reply_binary))
 
-    @inlineCallbacks
-    def send_message(self, address: Tuple, message: str, retries: int = 1):
-        # TryExcept is required because @inlineCallbacks wraps this piece of code so
-        # external TryExcept won't catch exceptions thrown here
+    def redirect_if_remote(self, session_name: str, address: Tuple):
+        # In cluster mode, requests for sessions living on another node are sent there
+        if self.cluster is None:
+            return
+        owner = self.cluster.remote_owner(session_name)
+        if owner is None:
+            return
+        if self.debug:
+            self.logger.debug("Session %s lives on %s:%s, redirecting", session_name, owner[0], owner[1])
+        payload = protocol.encode_redirect(owner) if self.reply_binary else bytes(f"r:{owner[0]}:{owner[1]}", "utf-8")
+        self.send_payload(address, payload)
+        raise IgnoredRequest
+
+    def get_start_payload(self, session: Session, player: Player) -> bytes:
+        relay_ids = self.relay.session_ids.get(session.name) if self.relay is not None else None
+        predicted_ports = natprobe.predict_ports(session) if natprobe.PROBE_PORTS else None
+        return session.get_start_payload(player, relay_ids, predicted_ports)
+
+    def send_token(self, address: Tuple, player: Player):
+        payload = protocol.encode_token(player.token) if self.reply_binary else bytes(f"t:{player.token}", "utf-8")
+        self.send_payload(address, payload)
+
+    def send_payload(self, address: Tuple, payload: bytes):
+        if self.request_replies is not None and address == self.request_address:
+            self.request_replies.append(payload)
+        self.metrics.packets_out += 1
+        self.metrics.bytes_out += len(payload)
         try:
-            if retries <= 1:
-                self.transport.write(bytes(message, "utf-8"), address)
-                return
-
-            for i in range(retries):
-                self.transport.write(bytes(message, "utf-8"), address)
-                yield sleep(UDP_MESSAGE_SECONDS_BETWEEN_TRIES)
+            self.transport.write(payload, address)
         except Exception as e:
             self.logger.error("Uncontrolled error: %s", str(e))
 
+    def send_message(self, address: Tuple, message: str, retries: int = 1, binary: bool = None):
+        # By default the message is encoded like the request being handled
+        if binary is None:
+            binary = self.reply_binary
+        if address == self.request_address:
+            # Errors are not cached, resent requests get them again through the checks below
+            self.request_replies = None
+        if message == ERR_REQUEST_INVALID and self.lag_monitor.overloaded and LOAD_SHEDDING_ENABLED:
+            self.lag_monitor.decisions["invalid_reply_shed"] += 1
+            return
+        # Replies to the request source have their own budget so the server cannot be used for amplification
+        if RATE_LIMIT_ENABLED and address == self.request_address \
+                and not self.rate_limiter.allow(self.rate_limit_source(address), ERROR_REPLY_CLASS):
+            return
+        self.metrics.count_error(message)
+        payload = protocol.encode_error(message) if binary else bytes(message, "utf-8")
+        if retries <= 1:
+            self.send_payload(address, payload)
+            return
+        self.retransmits.send(address, payload, RetryPolicy(retries, UDP_MESSAGE_SECONDS_BETWEEN_TRIES))
+
     """
     Parse messages helper methods 
     """
     def parse_session_player_from(self, message: str, source_address: Tuple) -> Tuple:
-        if not re.search(SESSION_PLAYER_REGEX, message):
+        if not SESSION_PLAYER_PATTERN.match(message):
             self.send_message(source_address, ERR_REQUEST_INVALID)
             self.logger.debug("Invalid session/player message received %s", message)
             raise InvalidRequest(f"Invalid session/player message received {message}")
@@ -242,8 +624,47 @@ class Server(DatagramProtocol):
         # Session, Player
         return split[0], split[1]
 
+    def parse_token_or_session_player_from(self, message: str, source_address: Tuple) -> Tuple:
+        # Pings and confirmations can send just the player token instead of the session and player names,
+        # the request is then the player itself
+        if ":" in message:
+            return self.parse_session_player_from(message, source_address)
+        if not TOKEN_PATTERN.match(message):
+            self.send_message(source_address, ERR_REQUEST_INVALID)
+            self.logger.debug("Invalid token message received %s", message)
+            raise InvalidRequest(f"Invalid token message received {message}")
+        return self.resolve_token(int(message), source_address),
+
+    def parse_versioned_ping(self, message: str, source_address: Tuple) -> Tuple:
+        if SESSION_PLAYER_VERSION_PATTERN.match(message):
+            session_name, player_name, version = message.split(":")
+            return session_name, player_name, int(version)
+        if TOKEN_VERSION_PATTERN.match(message):
+            token, version = message.split(":")
+            return self.resolve_token(int(token), source_address), int(version)
+        self.send_message(source_address, ERR_REQUEST_INVALID)
+        self.logger.debug("Invalid versioned ping received %s", message)
+        raise InvalidRequest(f"Invalid versioned ping received {message}")
+
+    def resolve_token(self, token: int, address: Tuple) -> Player:
+        player = self.players_by_address.get(address)
+        if player is None or player.token != token:
+            self.logger.debug("No player with token %s at %s:%s", token, address[0], address[1])
+            self.send_message(address, ERR_SESSION_PLAYER_NON_EXISTENT)
+            raise InvalidRequest(f"No player with token {token} at {address[0]}:{address[1]}")
+        return player
+
+    def parse_list_request(self, list_request: str, source_address: Tuple) -> Tuple:
+        if not LIST_PATTERN.match(list_request):
+            self.send_message(source_address, ERR_REQUEST_INVALID)
+            self.logger.debug("Invalid list message received %s", list_request)
+            raise InvalidRequest(f"Invalid list message received {list_request}")
+        split = list_request.split(":")
+        # Order, Page, Only sessions without password
+        return split[0], int(split[1]), len(split) == 3
+
     def parse_host_request(self, host_request: str, source_address: Tuple) -> Tuple:
-        if not re.search(SESSION_HOST_REGEX, host_request):
+        if not SESSION_HOST_PATTERN.match(host_request):
             self.send_message(source_address, ERR_REQUEST_INVALID)
             self.logger.debug("Invalid session/player message received %s", host_request)
             raise InvalidRequest(f"Invalid session/player message received {host_request}")
@@ -256,7 +677,7 @@ class Server(DatagramProtocol):
             return split[0], split[1], int(split[2]), split[3]
 
     def parse_connect_request(self, connect_request: str, source_address: Tuple) -> Tuple:
-        if not re.search(SESSION_PLAYER_PASS_REGEX, connect_request):
+        if not SESSION_PLAYER_PASS_PATTERN.match(connect_request):
             self.send_message(source_address, ERR_REQUEST_INVALID)
             self.logger.debug("Invalid session/player message received %s", connect_request)
             raise InvalidRequest(f"Invalid session/player message received {connect_request}")
@@ -272,7 +693,11 @@ class Server(DatagramProtocol):
     Checker methods
     """
     def check_host_session(self, session_name: str, address: Tuple):
-        ip, port = address
+        if self.cluster is not None and self.cluster.remote_owner(session_name) is not None \
+                and session_name not in self.active_sessions:
+            self.logger.debug("Session %s already exists on another node", session_name)
+            self.send_message(address, ERR_SESSION_EXISTS)
+            raise InvalidRequest(f"Session {session_name} already exists on another node")
         if session_name in self.starting_sessions:
             self.logger.debug("Session %s is already created and started", session_name)
             self.send_message(address, ERR_SESSION_EXISTS)
@@ -281,7 +706,7 @@ class Server(DatagramProtocol):
         if session_name in self.active_sessions:
             self.logger.debug("Session %s is already created", session_name)
             session = self.active_sessions[session_name]
-            if session.host.ip == ip and session.host.port == port:
+            if session.is_host(address):
                 self.send_session_info(address, session)
                 raise IgnoredRequest
             else:
@@ -290,7 +715,6 @@ class Server(DatagramProtocol):
                 raise InvalidRequest(f"A different player is trying to create the same session {session_name}")
 
     def check_connect_session(self, session_name: str, session_password: str, player_name: str, address: Tuple):
-        ip, port = address
         self.check_active_session(session_name, address)
         session = self.active_sessions[session_name]
         if not session.password_match(session_password):
@@ -302,7 +726,7 @@ class Server(DatagramProtocol):
             self.send_message(address, ERR_SESSION_FULL)
             raise InvalidRequest(f"Session {session_name} is full")
         if player_name in session.players.keys():
-            if ip == session.players[player_name].ip and port == session.players[player_name].port:
+            if session.players[player_name].address == address:
                 self.logger.debug("Player %s is already into session %s", player_name, session_name)
                 self.send_session_info(address, session)
                 raise IgnoredRequest
@@ -315,12 +739,14 @@ class Server(DatagramProtocol):
 
     def check_active_session(self, session_name: str, address: Tuple):
         if session_name not in self.active_sessions.keys():
+            self.redirect_if_remote(session_name, address)
             self.logger.debug("Session %s doesn't exist", session_name)
             self.send_message(address, ERR_SESSION_NON_EXISTENT)
             raise InvalidRequest(f"Session {session_name} doesn't exist")
 
     def check_starting_session(self, session_name: str, address: Tuple):
         if session_name not in self.starting_sessions.keys():
+            self.redirect_if_remote(session_name, address)
             self.logger.debug("Session %s is not starting", session_name)
             self.send_message(address, ERR_SESSION_NOT_STARTED)
             raise InvalidRequest(f"Session {session_name} is not starting")
@@ -341,37 +767,114 @@ class Server(DatagramProtocol):
     """
     Async background tasks
     """
+    def track_session(self, session_name: str):
+        session = self.active_sessions[session_name]
+        if self.session_expiry.add(session_name, session.expires_at()):
+            self.session_cleanup_call = self.schedule_cleanup(self.session_cleanup_call, self.session_expiry,
+                                                              self.cleanup_sessions)
+
+    def track_player(self, session_name: str, player_name: str):
+        player = self.active_sessions[session_name].players[player_name]
+        if self.player_expiry.add((session_name, player_name), player.expires_at()):
+            self.player_cleanup_call = self.schedule_cleanup(self.player_cleanup_call, self.player_expiry,
+                                                             self.cleanup_players)
+
+    def session_deadline(self, session_name: str):
+        if session_name not in self.active_sessions:
+            return None
+        return self.active_sessions[session_name].expires_at()
+
+    def player_deadline(self, key: Tuple):
+        session_name, player_name = key
+        if session_name not in self.active_sessions:
+            return None
+        session = self.active_sessions[session_name]
+        if player_name not in session.players:
+            return None
+        return session.players[player_name].expires_at()
+
+    def schedule_cleanup(self, call, index: ExpiryIndex, cleanup):
+        # Only one timer per index, armed for the earliest deadline it holds
+        if call is not None and call.active():
+            call.cancel()
+        deadline = index.next_deadline()
+        if deadline is None:
+            return None
+        delay = max(0, deadline - current_time_millis()) / 1000
+        return self.clock.callLater(delay, cleanup)
+
+    def create_player(self, player_name: str, address: Tuple) -> Player:
+        ip, port = address
+        player = Player(player_name, ip, port, self.reply_binary)
+        player.token = self.new_token()
+        self.index_player(player)
+        return player
+
+    def new_token(self) -> int:
+        token = self.new_routed_id(TOKEN_BITS)
+        if self.capture is not None:
+            self.capture.record_value(capture.KIND_TOKEN, token)
+        return token
+
+    def new_routed_id(self, bits: int) -> int:
+        value = secrets.randbits(bits)
+        if self.router is not None:
+            # In multi-process mode the id tells which worker owns it
+            value += self.router.index - value % self.router.workers
+        return value
+
+    def index_player(self, player: Player):
+        self.players_by_address[player.address] = player
+
+    def forget_player(self, player: Player):
+        if self.players_by_address.get(player.address) is player:
+            del self.players_by_address[player.address]
+
+    def session_changed(self, session: Session):
+        # Called after any change of the players of a session or when it stops being active or starting
+        self.response_cache.invalidate(session.name)
+        if self.active_sessions.get(session.name) is session:
+            self.lobbies.update(session)
+        else:
+            self.lobbies.remove(session.name)
+        if self.cluster is not None:
+            self.cluster.update(session.name, session.name in self.active_sessions
+                                or session.name in self.starting_sessions)
+
+    def count_players(self) -> int:
+        return sum(len(session.players) for session in self.active_sessions.values()) \
+               + sum(len(session.players) for session in self.starting_sessions.values())
+
     def cleanup_sessions(self):
-        if self.active_sessions:
-            self.logger.debug("Starting session cleanup")
-        for session_name in list(self.active_sessions.keys()):
-            session = self.active_sessions[session_name]
-            if session.is_timed_out():
-                del self.active_sessions[session_name]
-                for player in session.players_array:
-                    self.send_message((player.ip, player.port), ERR_SESSION_TIMEOUT, 3)
-                self.logger.info("Session %s deleted because it timed out", session.name)
-        reactor.callLater(SESSION_CLEANUP_SCHEDULED_SECONDS, self.cleanup_sessions)
+        started = time.perf_counter()
+        for session_name in self.session_expiry.pop_expired(current_time_millis()):
+            session = self.active_sessions.pop(session_name)
+            self.session_changed(session)
+            for player in session.players.values():
+                self.forget_player(player)
+                self.send_message(player.address, ERR_SESSION_TIMEOUT, 3, player.binary)
+            self.logger.info("Session %s deleted because it timed out", session.name)
+        self.session_cleanup_call = self.schedule_cleanup(None, self.session_expiry, self.cleanup_sessions)
+        self.metrics.cleanup_duration["sessions"].observe(time.perf_counter() - started)
 
     def cleanup_players(self):
-        if self.active_sessions:
-            self.logger.debug("Starting player cleanup")
-        for session_name in list(self.active_sessions.keys()):
+        started = time.perf_counter()
+        to_kick_by_session = {}
+        for session_name, player_name in self.player_expiry.pop_expired(current_time_millis()):
+            to_kick_by_session.setdefault(session_name, []).append(player_name)
+        for session_name, to_kick in to_kick_by_session.items():
             session = self.active_sessions[session_name]
-            to_kick = [player for player in session.players_array if player.is_timed_out()]
-            for player in to_kick:
-                session.remove_player(player.name)
-                self.send_message((player.ip, player.port), ERR_PLAYER_TIMEOUT, 3)
+            for player_name in to_kick:
+                player = session.players[player_name]
+                session.remove_player(player_name)
+                self.forget_player(player)
+                self.send_message(player.address, ERR_PLAYER_TIMEOUT, 3, player.binary)
                 self.logger.info("Kicked player %s from session %s because it timed out", player.name, session.name)
-            if not session.players_array:
+            if not session.players:
                 del self.active_sessions[session_name]
                 self.logger.info("No more players in session %s, deleted session", session_name)
-                continue
-            if to_kick:
+            self.session_changed(session)
+            if session.players:
                 self.broadcast_session_info(session)
-        reactor.callLater(PLAYER_CLEANUP_SCHEDULED_SECONDS, self.cleanup_players)
-
-
-# Helper method to pause execution for n seconds
-def sleep(seconds):
-    return deferLater(reactor, seconds, lambda: None)
+        self.player_cleanup_call = self.schedule_cleanup(None, self.player_expiry, self.cleanup_players)
+        self.metrics.cleanup_duration["players"].observe(time.perf_counter() - started)
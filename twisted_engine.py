@@ -0,0 +1,125 @@
+"""
+Twisted engine
+Runs the server on the twisted reactor, which is also the clock given to the server
+"""
+
+import socket
+
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from ingress import Ingress
+from metrics import Metrics
+from server import Server
+
+
+class TwistedProtocol(DatagramProtocol):
+
+    def __init__(self, server: Server):
+        self.server = server
+
+    def startProtocol(self):
+        self.server.transport = self.transport
+
+    def datagramReceived(self, datagram, address):
+        self.server.datagramReceived(datagram, address)
+
+
+class ProbeProtocol(DatagramProtocol):
+
+    def __init__(self, received):
+        self.received = received
+
+    def datagramReceived(self, datagram, address):
+        self.received(datagram, address)
+
+
+class BatchedReader:
+    # Reader registered in the reactor instead of a twisted port when ingress reads in batches
+
+    def __init__(self, ingress: Ingress):
+        self.ingress = ingress
+
+    def fileno(self) -> int:
+        return self.ingress.socket.fileno()
+
+    def doRead(self):
+        self.ingress.read()
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self) -> str:
+        return "BatchedReader"
+
+    def stopListening(self):
+        reactor.removeReader(self)
+
+
+class UdpListener:
+
+    def __init__(self, udp_socket: socket.socket, port):
+        # The socket is kept open so it can be handed over on a hot restart
+        self.socket = udp_socket
+        self.port = port
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def stop(self):
+        self.port.stopListening()
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        return self.metrics.render().encode("utf-8")
+
+
+def create_server() -> Server:
+    return Server(reactor)
+
+
+def listen(port: int, server: Server, udp_socket: socket.socket = None) -> UdpListener:
+    """
+    Starts reading from the given socket, or from a new one bound to the port
+    """
+    if udp_socket is None:
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(("", port))
+    udp_socket.setblocking(False)
+    ingress = Ingress(udp_socket, server)
+    if ingress.batched:
+        server.transport = ingress
+        reader = BatchedReader(ingress)
+        reactor.addReader(reader)
+        return UdpListener(udp_socket, reader)
+    return UdpListener(udp_socket, reactor.adoptDatagramPort(udp_socket.fileno(), socket.AF_INET,
+                                                             TwistedProtocol(server)))
+
+
+def listen_probe(port: int, received):
+    """
+    Listens on a probe port, received is called with every datagram and its source address
+    """
+    reactor.listenUDP(port, ProbeProtocol(received))
+
+
+def serve_metrics(port: int, metrics: Metrics):
+    reactor.listenTCP(port, Site(MetricsResource(metrics)), interface="127.0.0.1")
+
+
+def run():
+    reactor.run()
+
+
+def stop():
+    reactor.stop()
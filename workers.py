@@ -0,0 +1,199 @@
+"""
+Multi-process mode
+Several worker processes bind the same UDP port with SO_REUSEPORT. The kernel spreads
+datagrams by source address, not by session, so every session has an owner worker
+chosen by rendezvous hashing its name, and workers forward the datagrams of sessions
+they do not own to the owner. The owner answers from its own socket bound to the same
+port, so clients do not notice the difference.
+Every two workers talk through a unix datagram socket pair created by the supervisor.
+Named unix datagram sockets only queue net.unix.max_dgram_qlen datagrams (10 by default)
+per receiver and drop the rest when the receiver falls behind, connected pairs are only
+limited by the send buffer. Datagrams that do not fit in it are dropped and counted
+"""
+
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+from hashlib import blake2b
+from typing import List, Optional, Tuple
+
+from twisted.internet import reactor
+
+import logger
+import protocol
+from ingress import Ingress
+from twisted_engine import BatchedReader, TwistedProtocol
+
+# Send buffer of every channel between workers, the kernel caps it at net.core.wmem_max
+CHANNEL_BUFFER_BYTES = 4 * 2 ** 20
+# Datagrams read from a channel before going back to the reactor
+CHANNEL_READ_BATCH = 64
+
+# Forwarded datagrams are prefixed with the original source address
+ENVELOPE = struct.Struct("!4sH")
+
+
+def owner_of(session_name: bytes, workers: int) -> int:
+    # Rendezvous hashing, the builtin hash is randomized per process and crc32 seeded with
+    # the index does not mix well enough to spread names evenly
+    return max(range(workers),
+               key=lambda index: blake2b(session_name, digest_size=8, key=index.to_bytes(2, "big")).digest())
+
+
+def create_channels(workers: int) -> List[List[Optional[socket.socket]]]:
+    """
+    Returns the channels of every worker, channels[i][j] is the socket worker i sends to worker j through
+    """
+    channels = [[None] * workers for _ in range(workers)]
+    for first in range(workers):
+        for second in range(first + 1, workers):
+            channels[first][second], channels[second][first] = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    return channels
+
+
+class ChannelReader:
+    # Reader registered in the reactor for the channel from another worker
+
+    def __init__(self, router, channel: socket.socket):
+        self.router = router
+        self.channel = channel
+
+    def fileno(self) -> int:
+        return self.channel.fileno()
+
+    def doRead(self):
+        for _ in range(CHANNEL_READ_BATCH):
+            try:
+                envelope = self.channel.recv(65535)
+            except BlockingIOError:
+                return
+            self.router.envelope_received(envelope)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self) -> str:
+        return "ChannelReader"
+
+
+class ShardRouter:
+
+    def __init__(self, server, index: int, channels: List[Optional[socket.socket]]):
+        self.server = server
+        self.index = index
+        self.workers = len(channels)
+        self.channels = channels
+        self.forwarded = 0
+        self.dropped = 0
+        self.logger = logger.get_logger("ShardRouter")
+        server.metrics.add_counters("worker_forwards_total",
+                                    "Datagrams forwarded to the worker owning their session, by outcome",
+                                    lambda: {"sent": self.forwarded, "dropped": self.dropped}, "outcome")
+
+    def forward(self, datagram: bytes, address: Tuple) -> bool:
+        """
+        Sends the datagram to the worker owning its session. Returns False if
+        this worker has to handle it, either because it owns it or because it cannot be forwarded
+        """
+        token = protocol.peek_token(datagram)
+        relay_id = protocol.peek_relay_id(datagram)
+        if token is not None:
+            # Tokens and relay ids are handed out so that they tell their owner
+            owner = token % self.workers
+        elif relay_id is not None:
+            owner = relay_id % self.workers
+        else:
+            session_name = protocol.peek_session_name(datagram)
+            if session_name is None:
+                return False
+            owner = owner_of(session_name, self.workers)
+        if owner == self.index:
+            return False
+        ip, port = address
+        try:
+            self.channels[owner].send(ENVELOPE.pack(socket.inet_aton(ip), port) + datagram)
+        except BlockingIOError:
+            # The owner is behind and the channel buffer is full, the client will resend
+            self.dropped += 1
+            return True
+        except OSError as e:
+            self.logger.error("Could not forward datagram to worker %s: %s", owner, str(e))
+            return False
+        self.forwarded += 1
+        return True
+
+    def envelope_received(self, envelope: bytes):
+        packed_ip, port = ENVELOPE.unpack_from(envelope)
+        datagram = envelope[ENVELOPE.size:]
+        if self.server.relay is not None and protocol.is_relay(datagram):
+            self.server.relay.forward(datagram, (socket.inet_ntoa(packed_ip), port))
+        else:
+            self.server.handle_datagram(datagram, (socket.inet_ntoa(packed_ip), port))
+
+
+def listen_worker(port: int, index: int, channel_fds: List[Optional[int]], server):
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    udp_socket.bind(("", port))
+    udp_socket.setblocking(False)
+    ingress = Ingress(udp_socket, server)
+    if ingress.batched:
+        server.transport = ingress
+        reactor.addReader(BatchedReader(ingress))
+    else:
+        # Twisted duplicates the descriptor, ours is kept open for the socket buffer gauges of ingress
+        reactor.adoptDatagramPort(udp_socket.fileno(), socket.AF_INET, TwistedProtocol(server))
+
+    channels = [None if fd is None else socket.socket(fileno=fd) for fd in channel_fds]
+    server.router = ShardRouter(server, index, channels)
+    for channel in channels:
+        if channel is not None:
+            channel.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CHANNEL_BUFFER_BYTES)
+            channel.setblocking(False)
+            reactor.addReader(ChannelReader(server.router, channel))
+
+
+def parse_channel_fds(value: str) -> List[Optional[int]]:
+    # Descriptors of the channels to every worker, "-" for the worker itself
+    return [None if fd == "-" else int(fd) for fd in value.split(",")]
+
+
+def run_supervisor(port: int, workers: int, worker_args: List[str]):
+    """
+    Starts one process per worker running main.py with the given extra arguments
+    and waits for them, stopping all of them if any of them dies or a signal arrives
+    """
+    main_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    channels = create_channels(workers)
+    processes = []
+    for index in range(workers):
+        fds = [None if channel is None else channel.fileno() for channel in channels[index]]
+        processes.append(subprocess.Popen(
+            [sys.executable, main_file, str(port)] + worker_args
+            + ["--workers", str(workers), "--worker-index", str(index),
+               # Joined with = since the value can start with the "-" of worker 0
+               "--worker-channels=" + ",".join("-" if fd is None else str(fd) for fd in fds)],
+            pass_fds=[fd for fd in fds if fd is not None]))
+    # Only the workers use the channels
+    for worker_channels in channels:
+        for channel in worker_channels:
+            if channel is not None:
+                channel.close()
+
+    def stop(*_):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        os.wait()
+    except ChildProcessError:
+        pass
+    stop()
+    for process in processes:
+        process.wait()